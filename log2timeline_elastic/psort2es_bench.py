@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+
+# psort2es_bench.py
+#
+# Benchmarks for psort2es_proxy.py.
+#
+#   python psort2es_bench.py buffers [--size-mb 50] [--send-size 65536]
+#
+#     Relays a bulk body through a simulated slow link, once with the original bytearray relay
+#     of ClientThread (append with +=, consume with slicing) and once with RelayBuffer.
+#
+#   python psort2es_bench.py load [--engines thread asyncio] [--events 200000] [--flush-interval 1000]
+#                                 [--connections 1] [--rate 0] [--es-latency 0] [--es-mb-latency 0] [--reject-rate 0]
+#                                 [--proxy-args="..."]
+#
+#     Starts a fake ES and, per engine, the proxy in front of it, then replays synthetic plaso_event
+#     documents the way psort -o elastic sends them. Reports events/s, MB/s, p50/p99 _bulk latency
+#     and the peak RSS of the proxy (Linux).
+#
+#   python psort2es_bench.py mapping [--profiles full lean] [--events 100000] [--es-host localhost] [--es-port 9200]
+#
+#     Per mapping profile (--mapping-profile of the proxy), creates an index with that mapping on a
+#     real ES, loads synthetic plaso_event documents straight into it and reports the ingest rate,
+#     the index fields written per event and the store size once the index is refreshed and force
+#     merged to one segment. Against the fake ES, the store size is n/a.
+#
+#   python psort2es_bench.py fake-es [--port 9310] [--latency 0] [--mb-latency 0] [--reject-rate 0]
+#
+#     The fake ES of the load benchmark on its own: index PUT, _mapping, _settings, templates and _bulk, the
+#     latter answered after 'latency' seconds plus 'mb-latency' seconds per MB of body, with a share
+#     of 'reject-rate' items rejected (429). Documents sent again with the same _id are updated, or
+#     refused with 409 for create actions.
+#
+# LICENSE
+# This is free and unencumbered software released into the public domain.
+# For more information, please refer to <http://unlicense.org>
+
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import psort2es_proxy
+
+
+# Socket stand-in for the relay benchmarks: serves 'payload' to recv()/recv_into() in reads of at
+# most 'recv_size' bytes and accepts at most 'send_size' bytes per send(), like a slow link
+# that never drains the whole buffer at once.
+class SimulatedLink:
+
+    def __init__(self, payload, recv_size, send_size):
+        self.__payload = memoryview(payload)
+        self.__recv_size = recv_size
+        self.__send_size = send_size
+        self.__read_offset = 0
+        self.bytes_sent = 0
+
+    def recv(self, size):
+        size = min(size, self.__recv_size)
+        data = self.__payload[self.__read_offset:self.__read_offset + size].tobytes()
+        self.__read_offset += len(data)
+        return data
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.__recv_size, len(self.__payload) - self.__read_offset)
+        buffer[:size] = self.__payload[self.__read_offset:self.__read_offset + size]
+        self.__read_offset += size
+        return size
+
+    def send(self, data):
+        bytes_written = min(len(data), self.__send_size)
+        self.bytes_sent += bytes_written
+        return bytes_written
+
+    def exhausted(self):
+        return self.__read_offset >= len(self.__payload)
+
+
+# Read everything first, then drain through partial sends: the worst case for the copying relay,
+# reached in practice when ES is slower than psort.
+def relay_bytearray(link):
+    data = bytearray()
+    while not link.exhausted():
+        data += link.recv(psort2es_proxy.relay_recv_size)
+    while len(data) > 0:
+        bytes_written = link.send(data)
+        if bytes_written > 0:
+            data = data[bytes_written:]
+
+
+def relay_buffer(link):
+    data = psort2es_proxy.RelayBuffer()
+    while not link.exhausted():
+        data.recv_from(link)
+    while len(data) > 0:
+        data.send_to(link)
+
+
+def bench_buffers(args):
+    size = args.size_mb * 1024 * 1024
+    line = b'{"index":{"_index":"tl1","_type":"plaso_event"}}\n{"message":"' + b"x" * 400 + b'"}\n'
+    payload = (line * (size // len(line) + 1))[:size]
+
+    print("Relaying %d MB, %d bytes per send" % (args.size_mb, args.send_size))
+    for name, relay in (("bytearray (original)", relay_bytearray), ("RelayBuffer", relay_buffer)):
+        link = SimulatedLink(payload, psort2es_proxy.relay_recv_size, args.send_size)
+        start = time.perf_counter()
+        relay(link)
+        elapsed = time.perf_counter() - start
+        assert link.bytes_sent == size
+        print("  %-22s %8.3f s  %10.1f MB/s" % (name, elapsed, args.size_mb / elapsed))
+
+
+# Stand-in for ES: just enough of the REST API for psort and the proxy, on the proxy's own framing
+class FakeElasticsearch:
+
+    def __init__(self, latency, reject_rate, mb_latency=0.0):
+        self.__latency = latency
+        self.__mb_latency = mb_latency
+        self.__reject_rate = reject_rate
+        self.__indices = set()
+        self.__templates = {}
+        self.__ids = set() # (index, _id) of the documents sent with an _id
+        self.__settings = {} # index -> flat settings changed with PUT _settings
+        self.__documents = 0
+        self.__writers = set() # of the open connections
+
+    async def serve(self, reader, writer):
+        framer = psort2es_proxy.HttpRequestFramer()
+        self.__writers.add(writer)
+        try:
+            while True:
+                data = await reader.read(1024 * 1024)
+                if len(data) == 0:
+                    break
+                for request in framer.feed(data):
+                    response = await self.__handle(request)
+                    writer.writelines((response.head, response.body))
+                    await writer.drain()
+        except (OSError, psort2es_proxy.HttpFramingError):
+            pass
+        except asyncio.CancelledError:
+            pass # the fake ES stops while the proxy still holds the connection open
+        finally:
+            self.__writers.discard(writer)
+            writer.close()
+
+    # Closes the connections the proxy keeps open, so the server can stop
+    def close(self):
+        for writer in list(self.__writers):
+            writer.close()
+
+    async def __handle(self, request):
+        path = [part for part in request.path.split("/") if part]
+        if psort2es_proxy.is_bulk_request(request):
+            return await self.__bulk(request, path[0] if len(path) > 1 else None)
+
+        if request.method == "HEAD":
+            response = psort2es_proxy.HttpResponse("HTTP/1.1", 200 if path and path[0] in self.__indices else 404, "", [])
+            response.set_body(b"")
+            return response
+        if not path:
+            return psort2es_proxy.json_response(200, {"name": "psort2es_bench", "version": {"number": "6.4.0"}})
+        if path[0] in ("_template", "_index_template") and len(path) == 2:
+            if request.method == "PUT":
+                self.__templates[path[1]] = json.loads(request.decoded_body())
+                return psort2es_proxy.json_response(200, {"acknowledged": True})
+            if path[1] not in self.__templates:
+                return psort2es_proxy.json_response(404, {})
+            return psort2es_proxy.json_response(200, {path[1]: self.__templates[path[1]]})
+        if request.method == "PUT" and len(path) == 1:
+            if path[0] in self.__indices:
+                return psort2es_proxy.error_response(400, "resource_already_exists_exception", "index [%s] already exists" % path[0])
+            self.__indices.add(path[0])
+            return psort2es_proxy.json_response(200, {"acknowledged": True, "shards_acknowledged": True, "index": path[0]})
+        if request.method == "PUT" and "_mapping" in path:
+            if path[0] not in self.__indices:
+                return psort2es_proxy.error_response(404, "index_not_found_exception", "no such index")
+            return psort2es_proxy.json_response(200, {"acknowledged": True})
+        if len(path) == 2 and path[1] == "_settings" and path[0] in self.__indices:
+            if request.method == "PUT":
+                changes = json.loads(request.decoded_body())
+                settings = self.__settings.setdefault(path[0], {})
+                settings.update((name, value) for name, value in changes.items() if value is not None)
+                for name in [name for name, value in changes.items() if value is None]:
+                    settings.pop(name, None)
+                return psort2es_proxy.json_response(200, {"acknowledged": True})
+            return psort2es_proxy.json_response(200, {path[0]: {"settings": self.__settings.get(path[0], {})}})
+        if path[-1] in ("_search", "_count"):
+            return psort2es_proxy.json_response(200, {"took": 0, "hits": {"total": self.__documents, "hits": []}})
+        return psort2es_proxy.json_response(200, {"acknowledged": True})
+
+    async def __bulk(self, request, default_index):
+        latency = self.__latency + self.__mb_latency * len(request.body) / 1048576
+        if latency > 0:
+            await asyncio.sleep(latency)
+        items = []
+        for action, item in psort2es_proxy.split_bulk_items(request.decoded_body()):
+            for op, meta in action.items():
+                meta = dict(meta, _index=meta.get("_index", default_index))
+                if random.random() < self.__reject_rate:
+                    meta.update(status=429, error={"type": "es_rejected_execution_exception",
+                                                   "reason": "rejected execution of bulk item (queue capacity 200)"})
+                elif (meta["_index"], meta.get("_id")) in self.__ids:
+                    if op == "create":
+                        meta.update(status=409, error={"type": "version_conflict_engine_exception",
+                                                       "reason": "[plaso_event][%s]: version conflict, document already exists" % meta["_id"]})
+                    else:
+                        meta.update(_version=2, result="updated", status=200)
+                else:
+                    self.__documents += 1
+                    if "_id" in meta:
+                        self.__ids.add((meta["_index"], meta["_id"]))
+                    meta.update(_id=meta.get("_id", str(self.__documents)), _version=1, result="created", status=201)
+                items.append({op: meta})
+        errors = any(next(iter(item.values()))["status"] >= 300 for item in items)
+        return psort2es_proxy.json_response(200, {"took": int(latency * 1000), "errors": errors, "items": items})
+
+
+async def serve_fake_es(args):
+    fake = FakeElasticsearch(args.latency, args.reject_rate, args.mb_latency)
+    server = await asyncio.start_server(fake.serve, "localhost", args.port, backlog=128)
+    async with server:
+        try:
+            await server.serve_forever()
+        finally:
+            fake.close()
+
+
+def run_fake_es(args):
+    try:
+        asyncio.run(serve_fake_es(args))
+    except KeyboardInterrupt:
+        pass
+
+
+# Synthetic plaso_event documents, in the shape psort 20180818 sends them. dirty_rate is the share
+# of documents with values that do not fit the mapping (e.g. inode "62357-9").
+def plaso_events(count, doc_size, dirty_rate):
+    parsers = ["filestat", "winreg/windows_run", "winevtx", "prefetch", "chrome_history", "mft"]
+    events = []
+    for i in range(count):
+        parser = random.choice(parsers)
+        dirty = random.random() < dirty_rate
+        event = {
+            "data_type": "fs:stat" if parser in ("filestat", "mft") else parser.replace("/", ":"),
+            "datetime": "2018-08-%02dT%02d:%02d:%02d.%06d" % (random.randint(1, 28), random.randint(0, 23),
+                                                              random.randint(0, 59), random.randint(0, 59), random.randint(0, 999999)),
+            "display_name": "OS:C:/Windows/System32/config/file%d.dat" % i,
+            "filename": "/Windows/System32/config/file%d.dat" % i,
+            "hostname": "WKS-%03d" % random.randint(1, 50),
+            "inode": "%d-%d" % (random.randint(1, 99999), random.randint(1, 9)) if dirty else random.randint(1, 999999),
+            "is_allocated": "true" if dirty else True,
+            "parser": parser,
+            "pathspec": {"type_indicator": "TSK", "location": "/Windows/System32/config/file%d.dat" % i, "inode": i},
+            "tag": [],
+            "timestamp": random.randint(1300000000000000, 1540000000000000),
+            "timestamp_desc": random.choice(["Creation Time", "Content Modification Time", "Last Access Time"]),
+            "username": "-",
+        }
+        event["message"] = ("[%s] %s " % (parser, event["filename"])).ljust(doc_size - 400, "x")
+        events.append(event)
+    return events
+
+
+# One psort: checks and creates the index, then sends the events in _bulk requests of
+# flush_interval events, paced to 'rate' events/s if not 0. Latencies go to 'latencies'.
+class LoadClient(threading.Thread):
+
+    def __init__(self, port, index_name, documents, events, flush_interval, rate, latencies):
+        threading.Thread.__init__(self)
+        self.__port = port
+        self.__index_name = index_name
+        action = b'{"index": {"_index": "%s", "_type": "plaso_event"}}\n' % index_name.encode()
+        self.__lines = [action + document for document in documents]
+        self.__events = events
+        self.__flush_interval = flush_interval
+        self.__rate = rate
+        self.__latencies = latencies
+        self.bytes_sent = 0
+        self.rejected = 0
+        self.error = None
+
+    def run(self):
+        try:
+            self.__sock = socket.create_connection(("localhost", self.__port))
+            self.__framer = psort2es_proxy.HttpResponseFramer()
+            self.__exchange("HEAD", "/" + self.__index_name, None)
+            self.__exchange("PUT", "/" + self.__index_name,
+                            b'{"mappings": {"plaso_event": {"properties": {"datetime": {"type": "date"}}}}}')
+            self.__load()
+            self.__sock.close()
+        except (OSError, psort2es_proxy.HttpFramingError) as e:
+            self.error = e
+
+    def __load(self):
+        start = time.perf_counter()
+        sent = 0
+        while sent < self.__events:
+            count = min(self.__flush_interval, self.__events - sent)
+            body = b"".join(self.__lines[(sent + i) % len(self.__lines)] for i in range(count))
+            if self.__rate > 0:
+                delay = start + sent / self.__rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            request_start = time.perf_counter()
+            response = self.__exchange("POST", "/_bulk", body)
+            self.__latencies.append(time.perf_counter() - request_start)
+            self.bytes_sent += len(body)
+            if b'"errors": true' in response.body or b'"errors":true' in response.body:
+                self.rejected += sum(1 for item in json.loads(response.body)["items"] if next(iter(item.values()))["status"] >= 300)
+            sent += count
+
+    def __exchange(self, method, target, body):
+        request = psort2es_proxy.HttpRequest(method, target, "HTTP/1.1",
+                                             [("Host", "localhost:%d" % self.__port), ("Content-Type", "application/json")])
+        request.set_body(body or b"")
+        self.__framer.expect(method)
+        self.__sock.sendall(request.head + request.body)
+        while True:
+            data = self.__sock.recv(1024 * 1024)
+            if len(data) == 0:
+                raise ConnectionError("connection closed by the proxy")
+            for response in self.__framer.feed(data):
+                return response
+
+
+def wait_for_port(port, process, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("process exited with %d" % process.returncode)
+        try:
+            socket.create_connection(("localhost", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("port %d not listening after %.0f s" % (port, timeout))
+
+
+# Peak resident set size in MB, from /proc (Linux only)
+def peak_rss(pid):
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+def stop_process(process):
+    process.send_signal(2) # SIGINT, the proxy shuts down gracefully
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def bench_engine(args, engine, documents):
+    fake_es = subprocess.Popen([sys.executable, os.path.abspath(__file__), "fake-es", "--port", str(args.es_port),
+                                "--latency", str(args.es_latency), "--mb-latency", str(args.es_mb_latency),
+                                "--reject-rate", str(args.reject_rate)])
+    proxy = subprocess.Popen([sys.executable, os.path.abspath(psort2es_proxy.__file__), "--engine", engine, "-q",
+                              "--listen-port", str(args.proxy_port), "--es-port", str(args.es_port)] + shlex.split(args.proxy_args),
+                             stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.es_port, fake_es)
+        wait_for_port(args.proxy_port, proxy)
+
+        latencies = []
+        events = [args.events // args.connections + (1 if i < args.events % args.connections else 0) for i in range(args.connections)]
+        clients = [LoadClient(args.proxy_port, "bench%d" % i, documents, events[i], args.flush_interval,
+                              args.rate / args.connections, latencies) for i in range(args.connections)]
+        start = time.perf_counter()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+        rss = peak_rss(proxy.pid)
+    finally:
+        stop_process(proxy)
+        stop_process(fake_es)
+
+    for client in clients:
+        if client.error is not None:
+            print("  %-10s client failed: %s" % (engine, client.error))
+            return
+    latencies.sort()
+    megabytes = sum(client.bytes_sent for client in clients) / 1048576.0
+    print("  %-10s %10.0f %8.1f %9.1f %9.1f %10s %9d" % (
+        engine, args.events / elapsed, megabytes / elapsed, latencies[len(latencies) // 2] * 1000,
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        "%.1f" % rss if rss is not None else "n/a", sum(client.rejected for client in clients)))
+
+
+def bench_load(args):
+    random.seed(args.seed)
+    documents = [json.dumps(event).encode() + b"\n" for event in plaso_events(1000, args.doc_size, args.dirty_rate)]
+
+    print("%d events of about %d bytes in _bulk requests of %d, %d connection(s), ES latency %.0f ms, %.1f%% rejected" % (
+        args.events, args.doc_size, args.flush_interval, args.connections, args.es_latency * 1000, args.reject_rate * 100))
+    print("  %-10s %10s %8s %9s %9s %10s %9s" % ("engine", "events/s", "MB/s", "p50 ms", "p99 ms", "peak RSS", "rejected"))
+    for engine in args.engines:
+        bench_engine(args, engine, documents)
+
+
+# Index fields an event writes with a mapping: each mapped field, its subfields and copies to
+# alldata; fields the mapping does not know count as dynamically mapped strings.
+def index_fields(event, mapping):
+    properties = mapping["properties"]
+    dynamic = 1 if "dynamic_templates" in mapping else 2 # keyword, else text + keyword
+    return sum(1 + len(properties[name].get("fields", {})) + len(properties[name].get("copy_to", []))
+               if name in properties else dynamic for name in event)
+
+
+def es_exchange(connection, method, target, body=None):
+    connection.request(method, target, body, {"Content-Type": "application/json"})
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def bench_mapping(args):
+    random.seed(args.seed)
+    events = plaso_events(1000, args.doc_size, args.dirty_rate)
+    connection = http.client.HTTPConnection(args.es_host, args.es_port, timeout=600)
+
+    print("%d events of about %d bytes in _bulk requests of %d into %s:%d" % (
+        args.events, args.doc_size, args.flush_interval, args.es_host, args.es_port))
+    print("  %-8s %10s %8s %13s %12s %12s %10s" % ("profile", "events/s", "MB/s", "fields/event", "mapping KB", "store MB", "bytes/event"))
+    for profile in args.profiles:
+        mapping_body = psort2es_proxy.mapping_body(profile, args.alldata_fields)
+        mapping = json.loads(mapping_body)
+        field_types = psort2es_proxy.compile_field_types(mapping_body)
+        index = "%s-%s" % (args.index_prefix, profile)
+        action = json.dumps({"index": {"_index": index, "_type": psort2es_proxy.document_name}}).encode() + b"\n"
+        lines = []
+        for event in events:
+            document = dict(event)
+            psort2es_proxy.coerce_document(document, field_types)
+            lines.append(action + json.dumps(document).encode() + b"\n")
+
+        es_exchange(connection, "DELETE", "/" + index)
+        es_exchange(connection, "PUT", "/" + index, json.dumps({"settings": {"number_of_shards": 1, "number_of_replicas": 0}}).encode())
+        status, data = es_exchange(connection, "PUT", "/%s/_mapping/%s" % (index, psort2es_proxy.document_name), mapping_body.encode())
+        if status != 200:
+            print("  %-8s mapping rejected: %s" % (profile, data[:200].decode("utf-8", "replace")))
+            continue
+
+        sent = sent_bytes = 0
+        start = time.perf_counter()
+        while sent < args.events:
+            count = min(args.flush_interval, args.events - sent)
+            body = b"".join(lines[(sent + i) % len(lines)] for i in range(count))
+            status, data = es_exchange(connection, "POST", "/_bulk", body)
+            if status != 200:
+                raise RuntimeError("_bulk failed with %d: %s" % (status, data[:200].decode("utf-8", "replace")))
+            sent += count
+            sent_bytes += len(body)
+        elapsed = time.perf_counter() - start
+
+        es_exchange(connection, "POST", "/%s/_refresh" % index)
+        es_exchange(connection, "POST", "/%s/_forcemerge?max_num_segments=1" % index)
+        status, data = es_exchange(connection, "GET", "/%s/_stats/store,docs" % index)
+        try:
+            store = json.loads(data)["_all"]["primaries"]["store"]["size_in_bytes"]
+        except (ValueError, KeyError, TypeError):
+            store = None
+        if not args.keep:
+            es_exchange(connection, "DELETE", "/" + index)
+
+        print("  %-8s %10.0f %8.1f %13.1f %12.1f %12s %10s" % (
+            profile, args.events / elapsed, sent_bytes / elapsed / 1048576,
+            sum(index_fields(event, mapping) for event in events) / len(events), len(mapping_body) / 1024.0,
+            "%.1f" % (store / 1048576.0) if store is not None else "n/a",
+            "%.0f" % (store / args.events) if store is not None else "n/a"))
+    connection.close()
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="psort2es_proxy benchmarks.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    buffers = subparsers.add_parser("buffers", help="relay buffer micro-benchmark")
+    buffers.add_argument("--size-mb", type=int, default=50)
+    buffers.add_argument("--send-size", type=int, default=65536)
+    buffers.set_defaults(run=bench_buffers)
+
+    load = subparsers.add_parser("load", help="end to end benchmark of the proxy engines against a fake ES")
+    load.add_argument("--engines", nargs="+", default=["thread", "asyncio"])
+    load.add_argument("--events", type=int, default=200000)
+    load.add_argument("--flush-interval", type=int, default=1000, help="events per _bulk request, like psort's option")
+    load.add_argument("--connections", type=int, default=1, help="concurrent psort exports")
+    load.add_argument("--rate", type=float, default=0, help="events/s over all connections, 0: as fast as possible")
+    load.add_argument("--doc-size", type=int, default=1000, help="approximate bytes per document")
+    load.add_argument("--dirty-rate", type=float, default=0.01, help="share of documents with values off the mapping")
+    load.add_argument("--es-latency", type=float, default=0.0, help="seconds the fake ES takes per _bulk")
+    load.add_argument("--es-mb-latency", type=float, default=0.0, help="seconds the fake ES takes per MB of _bulk body")
+    load.add_argument("--reject-rate", type=float, default=0.0, help="share of _bulk items the fake ES rejects")
+    load.add_argument("--proxy-args", default="", help="further proxy options, e.g. --proxy-args=\"--rebatch --coerce\"")
+    load.add_argument("--proxy-port", type=int, default=9311)
+    load.add_argument("--es-port", type=int, default=9310)
+    load.add_argument("--seed", type=int, default=1)
+    load.set_defaults(run=bench_load)
+
+    mapping = subparsers.add_parser("mapping", help="index size and ingest rate of the mapping profiles on a real ES")
+    mapping.add_argument("--profiles", nargs="+", choices=("full", "lean"), default=["full", "lean"])
+    mapping.add_argument("--alldata-fields", nargs="+", metavar="FIELD", default=psort2es_proxy.mapping_alldata_fields)
+    mapping.add_argument("--events", type=int, default=100000)
+    mapping.add_argument("--flush-interval", type=int, default=1000)
+    mapping.add_argument("--doc-size", type=int, default=1000)
+    mapping.add_argument("--dirty-rate", type=float, default=0.01)
+    mapping.add_argument("--es-host", default=psort2es_proxy.target_elastic_host)
+    mapping.add_argument("--es-port", type=int, default=psort2es_proxy.target_elastic_port)
+    mapping.add_argument("--index-prefix", default="psort2es-bench-mapping")
+    mapping.add_argument("--keep", action="store_true", help="keep the indices instead of deleting them")
+    mapping.add_argument("--seed", type=int, default=1)
+    mapping.set_defaults(run=bench_mapping)
+
+    fake_es = subparsers.add_parser("fake-es", help="run the fake ES of the load benchmark")
+    fake_es.add_argument("--port", type=int, default=9310)
+    fake_es.add_argument("--latency", type=float, default=0.0)
+    fake_es.add_argument("--mb-latency", type=float, default=0.0)
+    fake_es.add_argument("--reject-rate", type=float, default=0.0)
+    fake_es.set_defaults(run=run_fake_es)
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = parse_command_line()
+    args.run(args)
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+# psort2es_load.py
+#
+# Loads psort exports into ES directly, without psort's single elastic output in the way.
+#
+#   psort.py -o json_line -w timeline.jsonl tl.plaso      (or -o l2tcsv -w timeline.csv)
+#   python psort2es_load.py timeline.jsonl --index tralala [--processes 8] [--es-node es1:9200 ...]
+#
+# The export is memory-mapped and cut at line boundaries into chunks, which a pool of processes
+# turns into plaso_event documents (coerced to the proxy's mapping like the proxy does) and sends
+# to ES in _bulk requests of about --batch-bytes / --batch-docs, one connection per process.
+# Items ES rejects with 429 are sent again after a growing delay. The index is created with the
+# proxy's mapping (putmappingbody of --mapping-profile, document_name) unless it exists.
+#
+# LICENSE
+# This is free and unencumbered software released into the public domain.
+# For more information, please refer to <http://unlicense.org>
+
+import argparse
+import calendar
+import csv
+import http.client
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import psort2es_proxy
+
+
+# Columns of psort's l2tcsv output, the first line of the file
+L2TCSV_COLUMNS = ["date", "time", "timezone", "MACB", "source", "sourcetype", "type", "user", "host", "short", "desc",
+                  "version", "filename", "inode", "notes", "format", "extra"]
+
+# l2tcsv column -> field of the elastic output
+L2TCSV_FIELDS = {"source": "source_short", "sourcetype": "source_long", "type": "timestamp_desc", "user": "username",
+                 "host": "hostname", "desc": "message", "format": "parser"}
+
+# Chunks are at most this large, so the progress can be reported while the pool works
+CHUNK_SIZE = 64 * 1024 * 1024
+
+
+def detect_format(path):
+    with open(path, "rb") as export:
+        first_line = export.readline()
+    return "l2tcsv" if first_line.startswith(b"date,time,timezone") else "json_line"
+
+
+# Start and end offsets of chunks of about chunk_size bytes, each ending with a complete line
+def split_at_lines(path, chunk_count, start=0):
+    size = os.path.getsize(path)
+    if size <= start:
+        return []
+    chunk_size = max((size - start) // chunk_count, 1)
+    chunks = []
+    with open(path, "rb") as export, mmap.mmap(export.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        while start < size:
+            end = data.find(b"\n", min(start + chunk_size, size - 1))
+            end = size if end < 0 else end + 1
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+# Document of a json_line event: the attribute container bookkeeping is dropped and the fields the
+# elastic output adds are filled in
+def json_line_document(line):
+    event = json.loads(line)
+    document = dict((key, value) for key, value in event.items() if not key.startswith("__"))
+    if isinstance(document.get("tag"), dict):
+        document["tag"] = document["tag"].get("labels", [])
+    if isinstance(document.get("pathspec"), dict):
+        document["pathspec"] = json.dumps(document["pathspec"], sort_keys=True)
+    if "datetime" not in document and isinstance(document.get("timestamp"), int):
+        seconds, microseconds = divmod(document["timestamp"], 1000000)
+        document["datetime"] = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(seconds)) + ".%06d" % microseconds
+    return document
+
+
+# Document of an l2tcsv line. Date and time are taken as UTC; the timezone column is kept.
+def l2tcsv_document(line):
+    values = next(csv.reader([line.decode("utf-8", "replace")]))
+    document = {}
+    for column, value in zip(L2TCSV_COLUMNS, values):
+        if value not in ("", "-") or column in ("user", "host"):
+            document[L2TCSV_FIELDS.get(column, column)] = value
+    try:
+        moment = time.strptime(document.pop("date") + " " + document.pop("time"), "%m/%d/%Y %H:%M:%S")
+        document["datetime"] = time.strftime("%Y-%m-%dT%H:%M:%S", moment)
+        document["timestamp"] = calendar.timegm(moment) * 1000000
+    except (KeyError, ValueError):
+        pass
+    return document
+
+
+# State of a pool process, see init_worker()
+worker = {}
+
+
+def init_worker(args):
+    host, port = random.choice(args.nodes)
+    worker.update(args=args, host=host, port=port, connection=None,
+                  field_types=psort2es_proxy.compile_field_types(psort2es_proxy.putmappingbody) if not args.no_coerce else None,
+                  action=json.dumps({"index": {"_index": args.index, "_type": psort2es_proxy.document_name}}).encode() + b"\n",
+                  to_document=l2tcsv_document if args.format == "l2tcsv" else json_line_document)
+
+
+def es_request(method, target, body=None):
+    for attempt in range(5):
+        if worker["connection"] is None:
+            worker["connection"] = http.client.HTTPConnection(worker["host"], worker["port"], timeout=300)
+        try:
+            worker["connection"].request(method, target, body, {"Content-Type": "application/x-ndjson"})
+            response = worker["connection"].getresponse()
+            data = response.read()
+            if response.status != 429 and response.status < 500:
+                return response.status, data
+        except (OSError, http.client.HTTPException):
+            worker["connection"].close()
+            worker["connection"] = None
+        time.sleep(min(2 ** attempt, psort2es_proxy.journal_retry_max_delay))
+    raise ConnectionError("%s %s failed 5 times" % (method, target))
+
+
+# Sends one _bulk request; items rejected with 429 are sent again after a random, growing delay.
+# Returns the number of documents ES did not take and the first error.
+def send_bulk(items):
+    failed = 0
+    first_error = None
+    for attempt in range(psort2es_proxy.bulk_retry_attempts + 1):
+        status, data = es_request("POST", "/_bulk", b"".join(items))
+        if status != 200:
+            return failed + len(items), first_error or data.decode("utf-8", "replace")[:500]
+        if b'"errors":false' in data or b'"errors": false' in data:
+            return failed, first_error
+
+        rejected = []
+        for item, result in zip(items, json.loads(data)["items"]):
+            item_status = next(iter(result.values())).get("status", 200)
+            if item_status == 429 and attempt < psort2es_proxy.bulk_retry_attempts:
+                rejected.append(item)
+            elif item_status >= 300:
+                failed += 1
+                first_error = first_error or json.dumps(result)
+        if not rejected:
+            break
+        items = rejected
+        time.sleep(random.uniform(0, min(psort2es_proxy.bulk_retry_delay * 2 ** attempt, psort2es_proxy.bulk_retry_max_delay)))
+    return failed, first_error
+
+
+# Loads the lines between start and end. Returns (documents, bytes, failed documents, first error),
+# the documents counting the lines that could not be read, which also count as failed.
+def load_chunk(chunk):
+    start, end = chunk
+    args = worker["args"]
+    documents = failed = sent_bytes = 0
+    first_error = None
+    items = []
+    batch_bytes = 0
+
+    def flush():
+        nonlocal failed, first_error, sent_bytes
+        lost, error = send_bulk(items)
+        failed += lost
+        first_error = first_error or error
+        sent_bytes += batch_bytes
+
+    with open(args.path, "rb") as export, mmap.mmap(export.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        position = start
+        while position < end:
+            line_end = data.find(b"\n", position, end)
+            line_end = end if line_end < 0 else line_end
+            line = data[position:line_end].rstrip(b"\r")
+            position = line_end + 1
+            if not line.strip():
+                continue
+            documents += 1
+            try:
+                document = worker["to_document"](line)
+            except ValueError as e:
+                failed += 1
+                first_error = first_error or "cannot read line: %s" % e
+                continue
+            if worker["field_types"] is not None:
+                psort2es_proxy.coerce_document(document, worker["field_types"])
+            item = worker["action"] + json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+            items.append(item)
+            batch_bytes += len(item)
+            if batch_bytes >= args.batch_bytes or len(items) >= args.batch_docs:
+                flush()
+                items = []
+                batch_bytes = 0
+    if items:
+        flush()
+    return documents, sent_bytes, failed, first_error
+
+
+def create_index(args):
+    init_worker(args)
+    status, data = es_request("HEAD", "/" + args.index)
+    if status == 200:
+        print("Index %s exists, its mapping is left as it is" % args.index)
+        return
+    status, data = es_request("PUT", "/" + args.index, b"{}")
+    if status != 200:
+        raise RuntimeError("cannot create index %s: %s" % (args.index, data.decode("utf-8", "replace")))
+    status, data = es_request("PUT", "/%s/_mapping/%s" % (args.index, psort2es_proxy.document_name),
+                              psort2es_proxy.putmappingbody.encode())
+    if status != 200:
+        raise RuntimeError("cannot add the mapping to %s: %s" % (args.index, data.decode("utf-8", "replace")))
+    print("Index %s created with the mapping" % args.index)
+
+
+def load(args):
+    args.format = detect_format(args.path) if args.format == "auto" else args.format
+    psort2es_proxy.putmappingbody = psort2es_proxy.mapping_body(args.mapping_profile, args.alldata_fields)
+    size = os.path.getsize(args.path)
+    with open(args.path, "rb") as export:
+        first_line_size = len(export.readline()) if args.format == "l2tcsv" else 0 # the header
+    chunks = split_at_lines(args.path, max(args.processes * 4, size // CHUNK_SIZE + 1), first_line_size)
+    documents = sent_bytes = failed = done = 0
+    first_error = None
+    start = time.perf_counter()
+    try:
+        create_index(args)
+
+        print("Loading %s (%s, %.1f MB) into %s with %d processes" % (args.path, args.format, size / 1048576, args.index, args.processes))
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.processes, init_worker, (args,)) as pool:
+            for done, (chunk_documents, chunk_bytes, chunk_failed, chunk_error) in enumerate(pool.imap_unordered(load_chunk, chunks), 1):
+                documents += chunk_documents
+                sent_bytes += chunk_bytes
+                failed += chunk_failed
+                first_error = first_error or chunk_error
+                elapsed = time.perf_counter() - start
+                print("  %d/%d chunks, %d events, %.0f events/s, %.1f MB/s, %d failed" % (
+                    done, len(chunks), documents, documents / elapsed, sent_bytes / elapsed / 1048576, failed))
+    except (ConnectionError, RuntimeError) as e:
+        print("Load aborted after %d/%d chunks, %d events sent, %d failed: %s" % (done, len(chunks), documents - failed, failed, e))
+        return 1
+
+    elapsed = time.perf_counter() - start
+    print("%d events loaded in %.1f s (%.0f events/s), %d failed" % (documents - failed, elapsed, documents / elapsed, failed))
+    if first_error is not None:
+        print("First error: %s" % first_error)
+    return 1 if failed else 0
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description="Loads psort json_line / l2tcsv exports into ElasticSearch in parallel.")
+    parser.add_argument("path", help="psort export (-o json_line or -o l2tcsv)")
+    parser.add_argument("--index", required=True, help="index to load into, created with the mapping if missing")
+    parser.add_argument("--format", choices=("auto", "json_line", "l2tcsv"), default="auto")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 4,
+                        help="processes sending _bulk requests in parallel (default: %(default)s)")
+    parser.add_argument("--es-host", default=psort2es_proxy.target_elastic_host)
+    parser.add_argument("--es-port", type=int, default=psort2es_proxy.target_elastic_port)
+    parser.add_argument("--es-node", action="append", metavar="HOST:PORT",
+                        help="Elasticsearch node to spread the processes over (repeatable)")
+    parser.add_argument("--batch-bytes", type=int, default=psort2es_proxy.bulk_batch_bytes)
+    parser.add_argument("--batch-docs", type=int, default=psort2es_proxy.bulk_batch_documents)
+    parser.add_argument("--mapping-profile", choices=("full", "lean"), default=psort2es_proxy.mapping_profile,
+                        help="mapping of a created index, see psort2es_proxy.py (default: %(default)s)")
+    parser.add_argument("--alldata-fields", nargs="+", metavar="FIELD", default=psort2es_proxy.mapping_alldata_fields,
+                        help="fields the lean mapping profile copies to alldata")
+    parser.add_argument("--no-coerce", action="store_true",
+                        help="send the values as they are instead of coercing them to the mapped types")
+    args = parser.parse_args()
+    args.nodes = ([(node.rpartition(":")[0], int(node.rpartition(":")[2])) for node in args.es_node]
+                  if args.es_node else [(args.es_host, args.es_port)])
+    return args
+
+
+if __name__ == '__main__':
+
+    sys.exit(load(parse_command_line()))
@@ -67,1109 +67,3670 @@
 # OTHER DEALINGS IN THE SOFTWARE.
 # For more information, please refer to <http://unlicense.org>
         
+import argparse
+import asyncio
+import base64
+import collections
+import functools
+import hashlib
+import http.server
+import itertools
+import json
+import logging
+import logging.handlers
+import math
+import mmap
+import os
+import queue
+import random
+import re
+import zlib
+import signal
 import socket
+import struct
 import threading
 import select
 import sys
+import time
+from http import HTTPStatus
+try:
+    import fcntl # splice() relay, Linux only
+except ImportError:
+    fcntl = None
 
 # Network settings
 proxy_listening_host = "localhost"
 proxy_listening_port = 9201
+proxy_listen_backlog = 128
 target_elastic_host = "localhost"
 target_elastic_port = 9200
 
-# Mapping we want the PLASO index to have.
-#    Can be extracted using https://github.com/mobz/elasticsearch-head
+# Upstream pool of the asyncio engine: requests are spread over these ES nodes ("host:port",
+# target_elastic_host:target_elastic_port if empty), each with up to upstream_pool_size pre-warmed
+# keep-alive connections. Nodes are health checked every upstream_health_interval seconds and a
+# failing node is left out for upstream_eject_time seconds, doubled on each further failure.
+target_elastic_nodes = []
+upstream_pool_size = 4
+upstream_health_interval = 5.0
+upstream_eject_time = 5.0
+upstream_eject_max_time = 120.0
+
+# Compression on the proxy -> ES leg (asyncio engine): request bodies of upstream_compress_min_size
+# bytes or more are sent "gzip" or "deflate" encoded, and responses are asked for gzip encoded
+# (ES needs http.compression: true for that) and decoded again for clients that did not ask for it.
+upstream_compression = None
+upstream_compression_level = 3
+upstream_compress_min_size = 1024
+
+# Relay buffers of the thread engine: bytes are received into preallocated blocks and relayed
+# from there without being copied again.
+relay_block_size = 1024 * 1024
+relay_recv_size = 102400
+
+# Once a thread engine connection needs no more inspection, it is relayed in the kernel with
+# splice() through a pipe of relay_splice_size bytes per direction (Linux only).
+relay_splice = hasattr(os, "splice")
+relay_splice_size = 1024 * 1024
+
+# Backpressure: a connection stops reading from the socket that produces its data once it buffers
+# buffer_high_watermark bytes in that direction and resumes at buffer_low_watermark. All
+# connections together stop reading at global_buffer_high_watermark buffered bytes and resume at
+# global_buffer_low_watermark. A connection of the asyncio engine in the middle of a request
+# finishes reading it first, as only complete requests are handed on and free their memory.
+buffer_high_watermark = 16 * 1024 * 1024
+buffer_low_watermark = 4 * 1024 * 1024
+global_buffer_high_watermark = 256 * 1024 * 1024
+global_buffer_low_watermark = 64 * 1024 * 1024
+
+# Largest request line + header block accepted by the HTTP framer
+http_max_head_size = 65536
+
+# Values of psort _bulk documents are coerced to the types of putmappingbody on the way to ES
+# (--coerce, asyncio engine). Values that cannot be coerced are moved to a "<field><suffix>" text
+# field instead of having ES reject the whole document. Every document is then decoded and
+# encoded again on the event loop, which costs about three quarters of the throughput.
+bulk_coerce_values = False
+coerce_invalid_suffix = "_unparsed"
+
+# Learning of field types (asyncio engine, with coercion). Fields putmappingbody does not list get
+# their type from the first value ES sees, and later values that do not fit it are rejected with
+# mapper_parsing_exception. The proxy then records the field type for that index, adds it and its
+# "<field><suffix>" text field to the index mapping, and coerces and re-sends the rejected items;
+# later documents for the index are coerced like the putmappingbody fields. Learned types are
+# kept in mapping_cache_file (--mapping-cache), so the next run starts with them.
+mapping_learning = True
+mapping_cache_file = None
+
+# Re-batching of psort _bulk requests (asyncio engine). Small requests are acknowledged right away
+# and merged into batches of about bulk_batch_bytes / bulk_batch_documents, flushed at the latest
+# bulk_batch_linger seconds after their first document. Larger requests are split into batches
+# and answered with the merged response.
+bulk_rebatch = False
+bulk_batch_bytes = 10 * 1024 * 1024
+bulk_batch_documents = 5000
+bulk_batch_linger = 1.0
+
+# Fan-out of large _bulk requests (--fanout N, asyncio engine). psort waits for the response to a
+# _bulk request before it sends the next one, so an export keeps a single ES connection busy. With
+# N > 1, a request of at least 2 * bulk_fanout_min_bytes is cut at document boundaries into up to N
+# slices that go to ES at the same time over separate pool connections, and psort gets a single
+# response with the items in request order. Requests naming an _id twice are sent whole, as the
+# order of their items matters.
+bulk_fanout = 1
+bulk_fanout_min_bytes = 512 * 1024
+
+# Retry of rejected _bulk items (asyncio engine). When ES answers items of a _bulk request with 429
+# (es_rejected_execution_exception, its write queue is full), only those items are sent again, in
+# one follow-up request per round, after a random delay of up to bulk_retry_delay * 2^round
+# seconds (at most bulk_retry_max_delay). Items still rejected after bulk_retry_attempts rounds are
+# passed on as rejected. psort gets a single response with the outcome of every item.
+bulk_retry_rejected = True
+bulk_retry_attempts = 5
+bulk_retry_delay = 0.1
+bulk_retry_max_delay = 10.0
+
+# Journal of psort _bulk requests (--journal DIR, asyncio engine). Requests are appended to
+# memory-mapped segment files of journal_segment_size bytes in DIR and acknowledged as soon as
+# they are on disk; appends made while an fsync runs share the next one. A drainer sends them to
+# ES in batches of up to bulk_batch_bytes, in order, and keeps its position in a checkpoint file,
+# so it resumes where it stopped after an ES outage or a proxy restart. journal_fsync = False
+# acknowledges once the request is in the page cache.
+journal_directory = None
+journal_segment_size = 64 * 1024 * 1024
+journal_fsync = True
+journal_retry_max_delay = 30.0
+
+# Index template (--template). The mapping is registered at startup as an index template for the
+# indices matching index_template_pattern and re-verified every index_template_verify_interval
+# seconds, so ES applies it itself when psort creates the index. While the template is in place,
+# index creations are not intercepted and, unless an HTTP level stage (coercion, re-batching,
+# retries, journal, compression) is enabled, connections are relayed byte for byte. "legacy" registers a _template
+# with the document type (ES 6.x), "composable" an _index_template (ES 7.8+).
+index_template = None
+index_template_name = "psort2es"
+index_template_pattern = "plaso*"
+index_template_verify_interval = 60.0
+
+# Bulk-load profile (--bulk-profile, asyncio engine). An index is switched to bulk_load_settings
+# when the proxy intercepts its creation or, e.g. with an index template, when the first _bulk
+# request for it comes in. Once the last client connection writing to it has been closed for
+# bulk_profile_close_delay seconds, or no _bulk request reached it for bulk_profile_idle_time
+# seconds, the settings it had before are restored and the index is refreshed and, with
+# bulk_profile_forcemerge (--forcemerge N), merged down to N segments. Stopping the proxy restores
+# the settings of all indices. A setting found at its bulk-load value, e.g. left by a proxy that was
+# killed, is restored to the default. Not with --workers: one worker would take the bulk-load
+# settings of another for those the index had before.
+bulk_profile = False
+bulk_load_settings = {"index.refresh_interval": "-1", "index.number_of_replicas": "0", "index.translog.durability": "async"}
+bulk_profile_close_delay = 10.0
+bulk_profile_idle_time = 300.0
+bulk_profile_forcemerge = None
+
+# Index routing (--route-time, --route-by, asyncio engine). The _index of every _bulk document psort
+# sends is rewritten to "<index>-<bucket>" of its datetime (index_routing_time "day": 2018.08.01,
+# "month": 2018.08, "year": 2018; "undated" without datetime or timestamp) and/or
+# "-<value>" of its index_routing_field, e.g. data_type "fs:stat" -> "fs_stat". Each target index
+# is created on first use with the mapping and with the psort index as alias, so searches on the
+# psort index name cover all of them and time-scoped searches can target single buckets. psort's
+# own creation of its index is answered by the proxy.
+index_routing_time = None
+index_routing_field = None
+
+# Deterministic document ids (--stable-ids, asyncio engine). psort lets ES generate the _id of its
+# documents, so exporting a timeline again after a failed run indexes every event twice. With
+# document_ids set, each _bulk document without _id gets a blake2b hash of its
+# document_id_fields (values as psort sent them) as _id. "index" overwrites the documents of
+# an earlier run, "create" turns the actions into create and leaves them as they are; ES answers
+# those with 409, which the proxy passes on as status 200, result "noop".
+document_ids = None
+document_id_fields = ["timestamp", "timestamp_desc", "data_type", "parser", "hostname", "pathspec", "filename", "inode",
+                      "offset", "record_number", "message"]
+
+# In-stream deduplication (--dedupe, asyncio engine). plaso emits some events several times, e.g.
+# from overlapping VSS snapshots. Each _bulk document gets a fingerprint of its target index and
+# its dedupe_fields (no pathspec, which names the snapshot); documents with a fingerprint seen
+# before are not sent to ES, and psort gets status 200, result "noop" items for them. Fingerprints
+# are recorded once ES took the document. The dedupe_recent_keys last ones are kept exactly, all of
+# them in a scalable Bloom filter of at most dedupe_max_bytes, which takes about a share of
+# dedupe_error_rate of the unique documents for duplicates. Beyond dedupe_max_bytes its oldest
+# fingerprints are forgotten. With dedupe_file (--dedupe-file) the filter is loaded at startup and
+# saved at shutdown, so the next run for the same case skips what ES took in this one. Not with
+# --workers: the workers would not see each other's duplicates.
+dedupe = False
+dedupe_fields = ["timestamp", "timestamp_desc", "data_type", "hostname", "filename", "inode", "offset", "record_number",
+                 "message"]
+dedupe_error_rate = 1e-6
+dedupe_capacity = 1 << 20
+dedupe_max_bytes = 512 * 1024 * 1024
+dedupe_recent_keys = 100000
+dedupe_file = None
+
+# Metrics endpoint (--metrics-port): Prometheus text format on http://metrics_host:metrics_port/metrics.
+# Request latencies are observed per endpoint into the metrics_latency_buckets (seconds).
+metrics_host = "localhost"
+metrics_port = None
+metrics_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Logging (-v / -q). Messages go through a queue of at most log_queue_size records to a writer
+# thread, so the relays never wait for the terminal; records that do not fit are dropped and
+# counted. Message bodies are cut to log_body_limit bytes. Instead of a mark per send, a progress
+# line with the rates is logged every log_progress_interval seconds while there is traffic.
+log_level = logging.INFO
+log_queue_size = 10000
+log_body_limit = 512
+log_progress_interval = 1.0
+
+# Worker mode (--workers N): N forked processes bind the listening port with SO_REUSEPORT, so the
+# kernel spreads the psort connections over them and each relays on a core of its own. The
+# supervisor restarts workers that die and adds up their metrics.
+proxy_workers = 1
+
+# Relay engine: "asyncio" serves all connections from a single event loop, "thread" is the
+# original one-thread-per-connection relay.
+proxy_engine = "asyncio"
+
+# Mapping we want the PLASO index to have, generated from the field table below for the
+# mapping_profile (--mapping-profile):
+#   "full"  every field also gets a <"copy_to": ["alldata"],> clause as there is no "_all" field in
+#           ES anymore, and text fields a keyword subfield, so no "raw_fields" are needed:
+#           app_version -> text, app_version.keyword -> raw
+#   "lean"  indexes less per event: identifiers and hashes are keyword only, text fields have no
+#           norms, labels are indexed without frequencies and positions (phrase queries go to
+#           their .keyword), prose has no keyword subfield, only the mapping_alldata_fields are
+#           copied to alldata, and fields the table does not know become keyword (their
+#           "<field><suffix>" twins of bulk_coerce_values text) through dynamic templates.
+# Roles: "prose" long free text, "path" paths, keys and URLs, "label" short values, "id"
+# identifiers and hashes, "flags" text without keyword subfield, else the ES type.
+#    The original mapping was extracted using https://github.com/mobz/elasticsearch-head
 #    No need to install, just download and start "file:///D:/Tools/elasticsearch-head-master/index.html"
-# The below mapping also adds a <"copy_to": ["alldata"],> clause as there is no "_all" field in ES anymore.
-# No need to add "raw_fields" as a keyword type is added for each field: app_version -> text, app_version.keyword -> raw
 document_name="plaso_event"
-putmappingbody= '''
-        {
-            "properties": {
-                "is_allocated": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "boolean"
-                },
-                "source_append": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "app_version": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "number_of_pages": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "record_number": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "number_of_words": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "doc_security": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "event_identifier": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "uuid": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "inode": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "sha2048_hash": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "datetime": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "date"
-                },
-                "number_of_characters": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "imphash": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "drive_serial_number": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "message_identifier": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "total_time": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "drive_type": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "droid_file_identifier": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "offset": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "revision_number": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "author": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "display_name": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "file_reference": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "number_of_lines": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "strings_parsed": {
-                    "type": "object"
-                },
-                "volume_label": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "filename": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "parser": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "size": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "name": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "relative_path": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "pe_type": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "template": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "pathspec": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "birth_droid_volume_identifier": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "file_attribute_flags": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text"
-                },
-                "origin": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "description": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "local_path": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "section_names": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "working_directory": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "command_line_arguments": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "file_system_type": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "long_name": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "localized_name": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "scale_crop": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "source_long": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "urls": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "source_short": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "strings": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "dll_name": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "mac_address": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "root": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "key_path": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "birth_droid_file_identifier": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "key": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "source_name": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "timestamp": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "computer_name": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "alldata": {
-                    "ignore_above": 4098,
-                    "type": "keyword"
-                },
-                "last_saved_by": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "hyperlinks_changed": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "icon_location": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "timestamp_desc": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "popularity_index": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "shell_item_path": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "i4": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "number_of_paragraphs": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "message": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "creating_app": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "xml_string": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "file_size": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "url": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "links_up_to_date": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "file_entry_type": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "number_of_characters_with_spaces": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "recovered": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "boolean"
-                },
-                "shared_doc": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "original_url": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "data_type": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "link_target": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "user_sid": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "event_level": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "long"
-                },
-                "droid_volume_identifier": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "type": {
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "terminal_identifier": {
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "user_identifier": {
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                },
-                "env_var_location": {
-                    "copy_to": [
-                        "alldata"
-                    ],
-                    "type": "text",
-                    "fields": {
-                        "keyword": {
-                            "ignore_above": 2048,
-                            "type": "keyword"
-                        }
-                    }
-                }
-            }
+MAPPING_FIELDS = {
+    "prose": "message description strings xml_string command_line_arguments section_names urls",
+    "path": """display_name filename relative_path local_path working_directory long_name localized_name
+               key_path key root icon_location shell_item_path url original_url link_target
+               env_var_location pathspec""",
+    "label": """parser data_type source_short source_long source_name timestamp_desc source_append
+                computer_name author last_saved_by creating_app app_version name template origin
+                dll_name pe_type file_system_type file_entry_type volume_label doc_security scale_crop
+                links_up_to_date shared_doc hyperlinks_changed revision_number total_time i4
+                number_of_pages number_of_words number_of_lines number_of_paragraphs number_of_characters
+                number_of_characters_with_spaces type terminal_identifier user_identifier""",
+    "id": """uuid user_sid mac_address file_reference imphash sha2048_hash droid_file_identifier
+             droid_volume_identifier birth_droid_file_identifier birth_droid_volume_identifier""",
+    "flags": "file_attribute_flags",
+    "long": """timestamp offset inode size file_size record_number event_identifier message_identifier
+               event_level drive_serial_number drive_type popularity_index""",
+    "boolean": "is_allocated recovered",
+    "date": "datetime",
+    "object": "strings_parsed",
+}
+# Fields the "full" profile does not copy to alldata
+MAPPING_NOT_IN_ALLDATA = ("type", "terminal_identifier", "user_identifier")
+mapping_profile = "full"
+mapping_alldata_fields = ["message", "display_name", "filename", "key_path", "url", "computer_name", "user_sid"]
+
+
+def mapping_body(profile, alldata_fields=()):
+    keyword = {"type": "keyword", "ignore_above": 2048}
+    text = {"type": "text", "fields": {"keyword": keyword}}
+    if profile == "lean":
+        roles = {
+            "prose": {"type": "text", "norms": False},
+            "path": {"type": "text", "norms": False, "fields": {"keyword": keyword}},
+            "label": {"type": "text", "norms": False, "index_options": "docs", "fields": {"keyword": keyword}},
+            "id": keyword,
+            "flags": {"type": "text", "norms": False, "index_options": "docs"},
         }
-'''
+    else:
+        roles = {"prose": text, "path": text, "label": text, "id": text, "flags": {"type": "text"}}
+    properties = {}
+    for role, names in MAPPING_FIELDS.items():
+        for name in names.split():
+            spec = properties[name] = dict(roles.get(role, {"type": role}))
+            if profile == "lean":
+                copy = name in alldata_fields
+            else:
+                copy = role != "object" and name not in MAPPING_NOT_IN_ALLDATA
+            if copy:
+                spec["copy_to"] = ["alldata"]
+    properties["alldata"] = {"type": "keyword", "ignore_above": 4098}
+    mapping = {"properties": properties}
+    if profile == "lean":
+        mapping["dynamic_templates"] = [
+            {"unparsed": {"match": "*" + coerce_invalid_suffix, "mapping": {"type": "text", "norms": False}}},
+            {"strings": {"match_mapping_type": "string", "mapping": keyword}},
+        ]
+    return json.dumps(mapping, indent=4)
+
+
+putmappingbody = mapping_body(mapping_profile)
+
+signal_term_proxy = False
+worker_index = None # set in the worker processes of --workers
+
+log = logging.getLogger("psort2es")
+
+
+# Byte queue of one relay direction. recv_from() reads straight into a preallocated block
+# (recv_into) and queues a memoryview of the received range, send_to() hands the queued views to
+# the socket and consume() only advances them. Once received, relayed bytes are never copied
+# again, whatever the number of partial sends.
+class RelayBuffer:
+
+    def __init__(self, block_size=None, recv_size=None, budget=None):
+        self.__block_size = block_size or relay_block_size
+        self.__recv_size = recv_size or relay_recv_size
+        self.__budget = budget
+        self.__chunks = collections.deque()
+        self.__size = 0
+        self.__block = None
+        self.__block_used = 0
+        self.__new_block()
+
+    def __len__(self):
+        return self.__size
+
+    def __new_block(self):
+        # Views on the previous block stay valid, the block is freed with its last view
+        self.__block = memoryview(bytearray(max(self.__block_size, self.__recv_size)))
+        self.__block_used = 0
+
+    def recv_from(self, sock):
+        if self.__size == 0 and not self.__chunks:
+            self.__block_used = 0 # nothing references the block anymore, start over
+        if len(self.__block) - self.__block_used < self.__recv_size:
+            self.__new_block()
+
+        start = self.__block_used
+        bytes_read = sock.recv_into(self.__block[start:start + self.__recv_size])
+        if bytes_read > 0:
+            self.append(self.__block[start:start + bytes_read])
+            self.__block_used += bytes_read
+        return bytes_read
+
+    def append(self, data):
+        if len(data) > 0:
+            self.__chunks.append(memoryview(data))
+            self.__size += len(data)
+            if self.__budget is not None:
+                self.__budget.add(len(data))
+
+    # Sends at most 'limit' bytes if given
+    def send_to(self, sock, limit=None):
+        if not self.__chunks:
+            return 0
+        if limit is not None and limit < self.__size:
+            chunks = []
+            for chunk in self.__chunks:
+                chunks.append(chunk[:limit])
+                limit -= len(chunks[-1])
+                if limit <= 0:
+                    break
+        else:
+            chunks = self.__chunks
+        if len(chunks) > 1 and hasattr(sock, "sendmsg"):
+            bytes_written = sock.sendmsg(list(itertools.islice(chunks, 0, 64)))
+        else:
+            bytes_written = sock.send(chunks[0])
+        self.consume(bytes_written)
+        return bytes_written
+
+    def consume(self, count):
+        self.__size -= count
+        if self.__budget is not None:
+            self.__budget.release(count)
+        while count > 0:
+            chunk = self.__chunks[0]
+            if len(chunk) <= count:
+                count -= len(chunk)
+                self.__chunks.popleft()
+            else:
+                self.__chunks[0] = chunk[count:]
+                count = 0
+
+    def chunks(self):
+        return iter(self.__chunks)
+
+    # The bytes of the last recv_from()/append()
+    def last_chunk(self):
+        return self.__chunks[-1]
+
+    def tobytes(self):
+        return b"".join(self.__chunks)
+
+# Bytes buffered by all connections together, against the global watermarks: exhausted() turns
+# true at global_buffer_high_watermark and false again at global_buffer_low_watermark.
+class MemoryBudget:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__paused = False
+        self.used = 0
+        self.peak = 0
+
+    def add(self, count):
+        with self.__lock:
+            self.used += count
+            self.peak = max(self.peak, self.used)
+            paused = not self.__paused and self.used >= global_buffer_high_watermark
+            if paused:
+                self.__paused = True
+        if paused:
+            metrics.add_backpressure_pause("global")
+
+    def release(self, count):
+        with self.__lock:
+            self.used -= count
+            if self.__paused and self.used <= global_buffer_low_watermark:
+                self.__paused = False
+
+    def exhausted(self):
+        return self.__paused
+
+    async def wait_available(self):
+        while self.__paused:
+            await asyncio.sleep(0.01)
+
+
+# One direction of a connection against the per-connection watermarks: paused from
+# buffer_high_watermark buffered bytes on, until back at buffer_low_watermark
+class Watermark:
+
+    def __init__(self):
+        self.paused = False
+
+    def check(self, size):
+        if not self.paused and size >= buffer_high_watermark:
+            self.paused = True
+            metrics.add_backpressure_pause("connection")
+        elif self.paused and size <= buffer_low_watermark:
+            self.paused = False
+        return self.paused
+
+
+# Counters of both engines, rendered by the metrics endpoint. Updated from the relay threads and
+# from the event loop alike, hence the lock. Buffer depths are sampled when rendering, through the
+# function each open connection registers.
+class ProxyMetrics:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__bytes = collections.Counter() # direction -> bytes
+        self.__messages = collections.Counter() # (direction, endpoint) -> messages
+        self.__latencies = {} # endpoint -> [count per bucket..., +Inf count, sum]
+        self.__bulk_items = collections.Counter() # "ok" / "error" -> items
+        self.__bulk_retries = collections.Counter() # "recovered" / "rejected" -> items retried
+        self.__coerced_values = 0
+        self.__pauses = collections.Counter() # "connection" / "global" -> backpressure pauses
+        self.__connections = {} # id -> function returning the (up, down) buffered bytes
+        self.__connection_ids = itertools.count(1)
+        self.__journal_backlog = None # function returning the bytes the journal has to drain
+        self.__dedupe_stats = None # function returning the dedupe outcomes per index
+
+    def add_bytes(self, direction, count):
+        with self.__lock:
+            self.__bytes[direction] += count
+
+    def add_message(self, direction, endpoint, size):
+        with self.__lock:
+            self.__messages[(direction, endpoint)] += 1
+            self.__bytes[direction] += size
+
+    def observe_latency(self, endpoint, seconds):
+        with self.__lock:
+            latency = self.__latencies.setdefault(endpoint, [0] * (len(metrics_latency_buckets) + 2))
+            for i, bound in enumerate(metrics_latency_buckets):
+                if seconds <= bound:
+                    latency[i] += 1
+            latency[-2] += 1
+            latency[-1] += seconds
+
+    def observe_bulk_items(self, items, errors):
+        with self.__lock:
+            self.__bulk_items["ok"] += items - errors
+            self.__bulk_items["error"] += errors
+
+    def observe_bulk_retries(self, items, rejected):
+        with self.__lock:
+            self.__bulk_retries["recovered"] += items - rejected
+            self.__bulk_retries["rejected"] += rejected
+
+    def add_backpressure_pause(self, scope):
+        with self.__lock:
+            self.__pauses[scope] += 1
+
+    def add_coerced_values(self, count):
+        with self.__lock:
+            self.__coerced_values += count
+
+    def open_connection(self, buffer_depths):
+        with self.__lock:
+            connection_id = next(self.__connection_ids)
+            self.__connections[connection_id] = buffer_depths
+            return connection_id
+
+    def close_connection(self, connection_id):
+        with self.__lock:
+            self.__connections.pop(connection_id, None)
+
+    def track_journal(self, backlog):
+        self.__journal_backlog = backlog
+
+    def track_dedupe(self, stats):
+        self.__dedupe_stats = stats
+
+    # Copy of the counters as plain data, which merge_metrics() can add up over worker processes
+    def snapshot(self):
+        with self.__lock:
+            snapshot = {"bytes": dict(self.__bytes), "messages": {},
+                        "latencies": dict((endpoint, list(latency)) for endpoint, latency in self.__latencies.items()),
+                        "bulk_items": dict(self.__bulk_items), "bulk_retries": dict(self.__bulk_retries),
+                        "coerced_values": self.__coerced_values,
+                        "pauses": dict(self.__pauses)}
+            for (direction, endpoint), count in self.__messages.items():
+                snapshot["messages"].setdefault(direction, {})[endpoint] = count
+            connections = list(self.__connections.items())
+        snapshot["connections"] = dict((str(connection_id), list(buffer_depths())) for connection_id, buffer_depths in connections)
+        snapshot["memory"] = {"buffered": memory_budget.used, "peak": memory_budget.peak}
+        snapshot["journal"] = {"backlog": self.__journal_backlog() if self.__journal_backlog is not None else 0}
+        snapshot["dedupe"] = self.__dedupe_stats() if self.__dedupe_stats is not None else {}
+        return snapshot
+
+
+# Sum of metrics snapshots: numbers are added, lists element by element, dicts key by key
+def merge_metrics(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for key, value in snapshot.items():
+            if key not in merged:
+                merged[key] = json.loads(json.dumps(value))
+            elif isinstance(value, dict):
+                merged[key] = merge_metrics([merged[key], value])
+            elif isinstance(value, list):
+                merged[key] = [a + b for a, b in zip(merged[key], value)]
+            else:
+                merged[key] += value
+    return merged
+
+
+# Running totals of a snapshot for the progress line
+def metrics_totals(snapshot):
+    bulk_items = snapshot.get("bulk_items", {})
+    return {"up": snapshot.get("bytes", {}).get("up", 0), "down": snapshot.get("bytes", {}).get("down", 0),
+            "requests": sum(snapshot.get("messages", {}).get("up", {}).values()),
+            "bulk_items": sum(bulk_items.values()), "bulk_errors": bulk_items.get("error", 0),
+            "coerced_values": snapshot.get("coerced_values", 0), "connections": len(snapshot.get("connections", {})),
+            "buffered": snapshot.get("memory", {}).get("buffered", 0), "journal": snapshot.get("journal", {}).get("backlog", 0)}
+
+
+# Prometheus text format of a snapshot
+def render_metrics(snapshot):
+    lines = ["# HELP psort2es_bytes_total Bytes relayed, up: psort -> ES, down: ES -> psort.",
+             "# TYPE psort2es_bytes_total counter"]
+    lines += ['psort2es_bytes_total{direction="%s"} %d' % (direction, snapshot["bytes"].get(direction, 0)) for direction in ("up", "down")]
+    lines += ["# HELP psort2es_messages_total HTTP requests (up) and responses (down) relayed per endpoint.",
+              "# TYPE psort2es_messages_total counter"]
+    lines += ['psort2es_messages_total{direction="%s",endpoint="%s"} %d' % (direction, endpoint, count)
+              for direction, endpoints in sorted(snapshot["messages"].items()) for endpoint, count in sorted(endpoints.items())]
+    lines += ["# HELP psort2es_request_duration_seconds Time from a request being read to its response being ready.",
+              "# TYPE psort2es_request_duration_seconds histogram"]
+    for endpoint, latency in sorted(snapshot["latencies"].items()):
+        lines += ['psort2es_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d' % (endpoint, bound, count)
+                  for bound, count in zip(metrics_latency_buckets + ("+Inf",), latency)]
+        lines.append('psort2es_request_duration_seconds_sum{endpoint="%s"} %f' % (endpoint, latency[-1]))
+        lines.append('psort2es_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, latency[-2]))
+    lines += ["# HELP psort2es_bulk_items_total _bulk items answered by ES, by outcome.",
+              "# TYPE psort2es_bulk_items_total counter"]
+    lines += ['psort2es_bulk_items_total{outcome="%s"} %d' % (outcome, snapshot["bulk_items"].get(outcome, 0)) for outcome in ("ok", "error")]
+    lines += ["# HELP psort2es_bulk_retried_items_total _bulk items rejected with 429 and retried, by final outcome.",
+              "# TYPE psort2es_bulk_retried_items_total counter"]
+    lines += ['psort2es_bulk_retried_items_total{outcome="%s"} %d' % (outcome, snapshot["bulk_retries"].get(outcome, 0))
+              for outcome in ("recovered", "rejected")]
+    lines += ["# HELP psort2es_coerced_values_total _bulk document values coerced to their mapped type.",
+              "# TYPE psort2es_coerced_values_total counter",
+              "psort2es_coerced_values_total %d" % snapshot["coerced_values"]]
+    lines += ["# HELP psort2es_buffered_bytes Bytes buffered by the proxy over all connections.",
+              "# TYPE psort2es_buffered_bytes gauge",
+              "psort2es_buffered_bytes %d" % snapshot["memory"]["buffered"],
+              "# HELP psort2es_buffered_bytes_peak Highest psort2es_buffered_bytes so far.",
+              "# TYPE psort2es_buffered_bytes_peak gauge",
+              "psort2es_buffered_bytes_peak %d" % snapshot["memory"]["peak"],
+              "# HELP psort2es_backpressure_pauses_total Times reading stopped at a high watermark, per connection or global.",
+              "# TYPE psort2es_backpressure_pauses_total counter"]
+    lines += ['psort2es_backpressure_pauses_total{scope="%s"} %d' % (scope, snapshot["pauses"].get(scope, 0)) for scope in ("connection", "global")]
+    lines += ["# HELP psort2es_journal_backlog_bytes Bytes of journaled _bulk requests not yet indexed by ES.",
+              "# TYPE psort2es_journal_backlog_bytes gauge",
+              "psort2es_journal_backlog_bytes %d" % snapshot["journal"]["backlog"]]
+    lines += ["# HELP psort2es_dedupe_documents_total _bulk documents of the dedupe stage per index, kept or dropped as exact or probable (Bloom filter) duplicates.",
+              "# TYPE psort2es_dedupe_documents_total counter"]
+    lines += ['psort2es_dedupe_documents_total{index="%s",outcome="%s"} %d' % (index, outcome, outcomes.get(outcome, 0))
+              for index, outcomes in sorted(snapshot.get("dedupe", {}).items()) for outcome in ("kept", "exact", "probable")]
+    lines += ["# HELP psort2es_active_connections Client connections being relayed.",
+              "# TYPE psort2es_active_connections gauge",
+              "psort2es_active_connections %d" % len(snapshot["connections"]),
+              "# HELP psort2es_connection_buffer_bytes Bytes buffered by the proxy per connection and direction.",
+              "# TYPE psort2es_connection_buffer_bytes gauge"]
+    for connection_id, (up, down) in sorted(snapshot["connections"].items()):
+        lines.append('psort2es_connection_buffer_bytes{connection="%s",direction="up"} %d' % (connection_id, up))
+        lines.append('psort2es_connection_buffer_bytes{connection="%s",direction="down"} %d' % (connection_id, down))
+    return "\n".join(lines) + "\n"
+
+
+metrics = ProxyMetrics()
+memory_budget = MemoryBudget()
+
+
+# QueueHandler on a bounded queue: a full queue drops the record instead of blocking the relay
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, log_queue):
+        logging.handlers.QueueHandler.__init__(self, log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Logs one line with the rates of the last interval, from a thread of its own, while there is
+# traffic
+class ProgressReporter(threading.Thread):
+
+    def __init__(self, handler, snapshot):
+        threading.Thread.__init__(self, daemon=True)
+        self.__handler = handler
+        self.__snapshot = snapshot
+        self.__stop = threading.Event()
+
+    def stop(self):
+        self.__stop.set()
+
+    def run(self):
+        previous = metrics_totals(self.__snapshot())
+        last = time.monotonic()
+        while not self.__stop.wait(log_progress_interval):
+            totals = metrics_totals(self.__snapshot())
+            now = time.monotonic()
+            elapsed = now - last
+            if totals["up"] != previous["up"] or totals["down"] != previous["down"] or totals["journal"] != previous["journal"]:
+                log.info("up %.1f MB/s %.0f req/s, down %.1f MB/s, %d connections, %.1f MB buffered, %d bulk items (%d rejected), %d values coerced%s%s",
+                         (totals["up"] - previous["up"]) / elapsed / 1048576,
+                         (totals["requests"] - previous["requests"]) / elapsed,
+                         (totals["down"] - previous["down"]) / elapsed / 1048576, totals["connections"], totals["buffered"] / 1048576,
+                         totals["bulk_items"], totals["bulk_errors"], totals["coerced_values"],
+                         ", %.1f MB journaled" % (totals["journal"] / 1048576) if totals["journal"] else "",
+                         ", %d log lines dropped" % self.__handler.dropped if self.__handler.dropped else "")
+            previous = totals
+            last = now
+
+
+# Routes the log records through the bounded queue to a writer thread, with a progress line
+# on the metrics 'snapshot' returns unless it is None. Returns the function that stops the writer
+# and the progress line and flushes what is queued.
+def setup_logging(snapshot, prefix=""):
+    for handler in list(log.handlers): # those of the supervisor in a forked worker
+        log.removeHandler(handler)
+    log_queue = queue.Queue(log_queue_size)
+    handler = BoundedQueueHandler(log_queue)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s " + prefix + "%(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    log.addHandler(handler)
+    log.setLevel(log_level)
+    log.propagate = False
+    listener.start()
+
+    progress = ProgressReporter(handler, snapshot)
+    if snapshot is not None and log_level <= logging.INFO:
+        progress.start()
+
+    def stop_logging():
+        progress.stop()
+        listener.stop()
+    return stop_logging
+
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics(self.server.snapshot()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serves the metrics from a thread of its own, for both engines and the worker supervisor
+def start_metrics_server(snapshot):
+    server = http.server.ThreadingHTTPServer((metrics_host, metrics_port), MetricsRequestHandler)
+    server.daemon_threads = True
+    server.snapshot = snapshot
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Metrics on http://%s:%d/metrics", metrics_host, metrics_port)
+    return server
+
+
+class HttpFramingError(Exception):
+    pass
+
+
+# HTTP/1.1 message as framed by HttpFramer. 'head' holds the raw start line and headers, 'body'
+# the payload without chunked transfer coding. set_body() replaces the payload and rewrites the
+# framing headers accordingly.
+class HttpMessage:
+
+    def __init__(self, version, headers, head=None):
+        self.version = version
+        self.headers = headers
+        self.head = head
+        self.body = b""
+        self.end_offset = None # position after the message in the byte stream
+        self.body_filter = None # filter that produced the body, see HttpFramer
+        if head is None:
+            self.set_body(b"")
+
+    def start_line(self):
+        raise NotImplementedError
+
+    def header(self, name, default=None):
+        name = name.lower()
+        for header_name, value in self.headers:
+            if header_name.lower() == name:
+                return value
+        return default
+
+    def set_header(self, name, value):
+        self.headers = [(header_name, header_value) for header_name, header_value in self.headers
+                        if header_name.lower() != name.lower()]
+        if value is not None:
+            self.headers.append((name, value))
+        self.set_body(self.body)
+
+    def set_body(self, body):
+        self.body = body
+        self.headers = [(name, value) for name, value in self.headers
+                        if name.lower() not in ("content-length", "transfer-encoding")]
+        self.headers.append(("Content-Length", str(len(body))))
+        lines = [self.start_line()]
+        lines.extend("%s: %s" % header for header in self.headers)
+        self.head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    def keep_alive(self):
+        connection = self.header("Connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    # Body with any Content-Encoding removed, for inspection only
+    def decoded_body(self):
+        encoding = self.header("Content-Encoding", "identity").lower()
+        if encoding == "gzip":
+            return zlib.decompress(self.body, 16 + zlib.MAX_WBITS)
+        if encoding == "deflate":
+            return zlib.decompress(self.body)
+        return self.body
+
+    # Head and body for the log, the body cut to log_body_limit bytes
+    def describe(self):
+        body = self.decoded_body()
+        if len(body) > log_body_limit:
+            body = body[:log_body_limit] + b"... (%d bytes)" % len(body)
+        return self.head.decode("latin-1") + body.decode("utf-8", "replace")
+
+
+class HttpRequest(HttpMessage):
+
+    def __init__(self, method, target, version, headers, head=None):
+        self.method = method
+        self.target = target
+        HttpMessage.__init__(self, version, headers, head)
+
+    @property
+    def path(self):
+        return self.target.split("?", 1)[0]
+
+    def start_line(self):
+        return "%s %s %s" % (self.method, self.target, self.version)
+
+
+class HttpResponse(HttpMessage):
+
+    def __init__(self, version, status, reason, headers, head=None):
+        self.status = status
+        self.reason = reason
+        self.request_method = None # method of the request answered, set by HttpResponseFramer
+        HttpMessage.__init__(self, version, headers, head)
+
+    def start_line(self):
+        return "%s %d %s" % (self.version, self.status, self.reason)
+
+
+# Incremental byte-level HTTP/1.1 framer. feed() takes the bytes as they arrive and returns the
+# messages completed by them. Start line and headers are parsed once, bodies are delimited by
+# Content-Length or chunked transfer coding without rescanning them.
+# body_filter(message) is called once the head is parsed and may return an object whose feed()
+# gets the body as it arrives and whose finish() returns the body to forward instead.
+class HttpFramer:
+
+    __HEAD, __BODY, __CHUNK_SIZE, __CHUNK_DATA, __CHUNK_END, __TRAILER, __UNTIL_CLOSE = range(7)
+
+    def __init__(self, body_filter=None):
+        self.__body_filter = body_filter
+        self.__filter = None
+        self.__buffer = bytearray()
+        self.__state = self.__HEAD
+        self.__message = None
+        self.__remaining = 0
+        self.__body_parts = []
+        self.__fed = 0
+
+    # Bytes of the message currently being received
+    def pending(self):
+        return len(self.__buffer) + sum(len(part) for part in self.__body_parts)
+
+    def feed(self, data):
+        messages = []
+        view_start = self.__fed - len(self.__buffer) # stream offset of data[0]
+        self.__fed += len(data)
+        if self.__buffer:
+            self.__buffer += data
+            data = bytes(self.__buffer)
+            self.__buffer = bytearray()
+        elif not isinstance(data, (bytes, bytearray)):
+            data = bytes(data)
+        view = memoryview(data)
+        pos = 0
+
+        while pos < len(view):
+            if self.__state in (self.__BODY, self.__CHUNK_DATA, self.__UNTIL_CLOSE):
+                take = len(view) - pos
+                if self.__state != self.__UNTIL_CLOSE:
+                    take = min(self.__remaining, take)
+                    self.__remaining -= take
+                self.__add_body(view[pos:pos + take])
+                pos += take
+                if self.__remaining == 0:
+                    if self.__state == self.__BODY:
+                        messages.append(self.__finish(view_start + pos))
+                    elif self.__state == self.__CHUNK_DATA:
+                        self.__state = self.__CHUNK_END
+                continue
+
+            if self.__state == self.__HEAD and data.startswith(b"\r\n", pos):
+                pos += 2 # tolerate stray CRLF between messages
+                continue
+
+            terminator = b"\r\n\r\n" if self.__state == self.__HEAD else b"\r\n"
+            end = data.find(terminator, pos)
+            if end < 0:
+                if len(view) - pos > http_max_head_size:
+                    raise HttpFramingError("HTTP head or chunk line too long")
+                self.__buffer += view[pos:]
+                break
+            line = data[pos:end]
+            pos = end + len(terminator)
+
+            if self.__state == self.__HEAD:
+                if self.__parse_head(line, data[end - len(line):pos]):
+                    messages.append(self.__finish(view_start + pos))
+            elif self.__state == self.__CHUNK_SIZE:
+                try:
+                    size = int(line.split(b";", 1)[0].strip(), 16)
+                except ValueError:
+                    raise HttpFramingError("bad chunk size %r" % line[:32])
+                if size == 0:
+                    self.__state = self.__TRAILER
+                else:
+                    self.__remaining = size
+                    self.__state = self.__CHUNK_DATA
+            elif self.__state == self.__CHUNK_END:
+                if len(line) > 0:
+                    raise HttpFramingError("missing CRLF after chunk")
+                self.__state = self.__CHUNK_SIZE
+            elif self.__state == self.__TRAILER:
+                if len(line) == 0:
+                    messages.append(self.__finish(view_start + pos))
+
+        return messages
+
+    # End of stream: completes a body delimited by the connection close
+    def feed_eof(self):
+        if self.__state == self.__UNTIL_CLOSE:
+            return [self.__finish(self.__fed)]
+        if self.__state != self.__HEAD or self.__buffer:
+            raise HttpFramingError("connection closed in the middle of a message")
+        return []
+
+    def __add_body(self, data):
+        if self.__filter is not None:
+            self.__filter.feed(data)
+        else:
+            self.__body_parts.append(data.tobytes())
+
+    def __parse_head(self, head, raw_head):
+        lines = head.decode("latin-1").split("\r\n")
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise HttpFramingError("bad header line %r" % line[:80])
+            headers.append((name.strip(), value.strip()))
+
+        self.__message = message = self._new_message(lines[0], headers, bytes(raw_head))
+        if self._without_body(message):
+            return True
+        if "chunked" in message.header("Transfer-Encoding", "").lower():
+            self.__state = self.__CHUNK_SIZE
+        elif message.header("Content-Length") is not None:
+            try:
+                self.__remaining = int(message.header("Content-Length"))
+            except ValueError:
+                raise HttpFramingError("bad Content-Length")
+            if self.__remaining == 0:
+                return True
+            self.__state = self.__BODY
+        elif self._length_until_close(message):
+            self.__state = self.__UNTIL_CLOSE
+        else:
+            return True
+
+        if self.__body_filter is not None:
+            self.__filter = self.__body_filter(message)
+        return False
+
+    def __finish(self, end_offset):
+        message = self.__message
+        message.end_offset = end_offset
+        if self.__filter is not None:
+            message.set_body(self.__filter.finish())
+            message.body_filter = self.__filter
+            self.__filter = None
+        elif self.__state == self.__BODY:
+            message.body = b"".join(self.__body_parts)
+        elif self.__state in (self.__TRAILER, self.__UNTIL_CLOSE):
+            message.set_body(b"".join(self.__body_parts)) # re-framed with Content-Length
+        self.__message = None
+        self.__body_parts = []
+        self.__state = self.__HEAD
+        return message
+
+    def _new_message(self, start_line, headers, head):
+        raise NotImplementedError
+
+    def _without_body(self, message):
+        return False
+
+    def _length_until_close(self, message):
+        return False
+
+
+class HttpRequestFramer(HttpFramer):
+
+    def _new_message(self, start_line, headers, head):
+        try:
+            method, target, version = start_line.split(" ")
+        except ValueError:
+            raise HttpFramingError("bad request line %r" % start_line[:80])
+        return HttpRequest(method, target, version, headers, head)
+
+
+# Responses are framed against the methods of the requests they answer, given in order to
+# expect(): a HEAD response has no body whatever its headers say.
+class HttpResponseFramer(HttpFramer):
+
+    def __init__(self, body_filter=None):
+        HttpFramer.__init__(self, body_filter)
+        self.__methods = collections.deque()
+
+    def expect(self, method):
+        self.__methods.append(method)
+
+    def _new_message(self, start_line, headers, head):
+        try:
+            version, status, reason = (start_line.split(" ", 2) + [""])[:3]
+            status = int(status)
+        except ValueError:
+            raise HttpFramingError("bad status line %r" % start_line[:80])
+        response = HttpResponse(version, status, reason, headers, head)
+        response.request_method = self.__methods[0] if self.__methods else None
+        if status >= 200:
+            if self.__methods:
+                self.__methods.popleft()
+        return response
+
+    def _without_body(self, response):
+        return response.status < 200 or response.status in (204, 304) or response.request_method == "HEAD"
+
+    def _length_until_close(self, response):
+        return True
+
+
+# Index name if the request creates an index with mappings (what psort does on startup), None otherwise
+def index_creation_target(request):
+    if request.method != "PUT":
+        return None
+    index_name = request.path.strip("/")
+    if len(index_name) == 0 or "/" in index_name or index_name.startswith("_"):
+        return None
+    try:
+        body = request.decoded_body()
+    except zlib.error:
+        return None
+    if b"mappings" not in body:
+        return None
+    return index_name
+
+
+def is_bulk_request(request):
+    return request.path == "/_bulk" or request.path.endswith("/_bulk")
+
+
+# Endpoint label of the metrics: "_bulk", "search", "mapping" (index creation, mappings, templates)
+# or "other"
+def request_endpoint(request):
+    if is_bulk_request(request):
+        return "_bulk"
+    name = request.path.rstrip("/").rpartition("/")[2]
+    if name in ("_search", "_msearch", "_count", "scroll") or "/_search/" in request.path:
+        return "search"
+    if "/_mapping" in request.path or "_template/" in request.path or index_creation_target(request) is not None:
+        return "mapping"
+    return "other"
+
+
+# Counts the items of a _bulk response and those ES rejected into the metrics
+def observe_bulk_response(response):
+    if response.status != 200:
+        return
+    try:
+        items = json.loads(response.decoded_body()).get("items", [])
+    except ValueError:
+        return
+    metrics.observe_bulk_items(len(items), sum(1 for item in items if next(iter(item.values())).get("status", 200) >= 300))
+
+
+# Field -> type table of the top level properties of a mapping, e.g. {"inode": "long", ...}
+@functools.lru_cache(maxsize=4)
+def compile_field_types(mapping_body):
+    properties = json.loads(mapping_body).get("properties", {})
+    return dict((name, spec.get("type", "object")) for name, spec in properties.items())
+
+
+_INVALID = object()
+_INTEGER_PATTERN = re.compile(r"[+-]?[0-9]+\Z")
+_DATE_PATTERN = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
+
+def _coerce_long(value):
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif isinstance(value, str):
+        text = value.strip()
+        if _INTEGER_PATTERN.match(text):
+            value = int(text)
+        elif text[:2].lower() == "0x":
+            try:
+                value = int(text, 16)
+            except ValueError:
+                return _INVALID
+    if isinstance(value, int) and -2 ** 63 <= value < 2 ** 63:
+        return value
+    return _INVALID
+
+
+def _coerce_double(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return _INVALID
+
+
+def _coerce_boolean(value):
+    if isinstance(value, bool):
+        return value
+    if value in (0, 1):
+        return bool(value)
+    if isinstance(value, str) and value.strip().lower() in ("true", "false", ""):
+        return value.strip().lower() == "true"
+    return _INVALID
+
+
+def _coerce_date(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value # epoch_millis
+    if isinstance(value, str) and _DATE_PATTERN.match(value):
+        return value
+    return _INVALID
+
+
+def _coerce_text(value):
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def _coerce_object(value):
+    return value if isinstance(value, dict) else _INVALID
+
+
+_COERCERS = {
+    "long": _coerce_long, "integer": _coerce_long, "short": _coerce_long, "byte": _coerce_long,
+    "double": _coerce_double, "float": _coerce_double,
+    "boolean": _coerce_boolean,
+    "date": _coerce_date,
+    "text": _coerce_text, "keyword": _coerce_text,
+    "object": _coerce_object,
+}
+
+
+# Coerces the values of one document to the mapped types in place, returns the number of fields
+# changed. Arrays are coerced element by element.
+def coerce_document(document, field_types):
+    changed = 0
+    for field in [field for field in document if field in field_types]:
+        coercer = _COERCERS.get(field_types[field])
+        if coercer is None:
+            continue
+        value = document[field]
+        if isinstance(value, list) and coercer is not _coerce_text:
+            coerced = [coercer(element) for element in value]
+            if _INVALID in coerced:
+                coerced = _INVALID
+        else:
+            coerced = coercer(value)
+
+        if coerced is _INVALID:
+            del document[field]
+            document[field + coerce_invalid_suffix] = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+            changed += 1
+        elif coerced is not value and (coerced != value or type(coerced) is not type(value)):
+            document[field] = coerced
+            changed += 1
+    return changed
+
+
+# Streaming rewriter of psort _bulk NDJSON bodies: complete lines are processed as the body
+# arrives, action lines are passed through and the source lines following them are coerced
+# against the field type table field_types_of() gives for the index of the action (default_index
+# when the action names none). Unchanged lines are re-emitted byte for byte.
+class BulkRewriter:
+
+    def __init__(self, field_types_of, default_index=None, router=None, deduplicator=None):
+        self.__field_types_of = field_types_of
+        self.__default_index = default_index
+        self.__router = router
+        self.__deduplicator = deduplicator
+        self.__field_types = None
+        self.__action = None # (action, line) held back until the source line gives its target and _id
+        self.__tail = b""
+        self.__output = []
+        self.__expect_source = False
+        self.documents = 0
+        self.coerced_values = 0
+        self.indices = {} # routed index -> psort index, its alias
+        self.items = 0
+        self.dropped = [] # (position, response item) of the documents the dedupe stage dropped
+        self.pending = [] # dedupe fingerprints made pending, until the documents are handed over to ES
+
+    def feed(self, data):
+        data = self.__tail + bytes(data)
+        start = 0
+        end = data.find(b"\n")
+        while end >= 0:
+            self.__line(data[start:end + 1])
+            start = end + 1
+            end = data.find(b"\n", start)
+        self.__tail = data[start:]
+
+    def finish(self):
+        if self.__tail:
+            self.__line(self.__tail)
+            self.__tail = b""
+        if self.__action is not None:
+            self.__output.append(self.__action[1])
+            self.__action = None
+        body = b"".join(self.__output)
+        self.__output = []
+        return body
+
+    def __line(self, line):
+        if not self.__expect_source:
+            if line.strip():
+                self.items += 1
+                # Every action but delete is followed by a source line
+                try:
+                    action = json.loads(line)
+                    self.__expect_source = "delete" not in action
+                    if self.__expect_source:
+                        meta = next(iter(action.values()), {})
+                        index = meta.get("_index", self.__default_index)
+                        if ((self.__router is not None and index is not None) or document_ids is not None
+                                or self.__deduplicator is not None):
+                            self.__action = (action, line)
+                            return
+                        self.__field_types = self.__field_types_of(index) if self.__field_types_of is not None else None
+                except (ValueError, AttributeError):
+                    self.__expect_source = False
+            self.__output.append(line)
+            return
+
+        self.__expect_source = False
+        self.documents += 1
+        try:
+            document = json.loads(line)
+        except ValueError:
+            document = None
+        if not isinstance(document, dict):
+            document = None
+        if self.__action is not None:
+            self.__target(document)
+        changed = coerce_document(document, self.__field_types) if document is not None and self.__field_types is not None else 0
+        if self.__action is not None and not self.__write_action(document):
+            return
+        if changed == 0:
+            self.__output.append(line)
+            return
+        self.coerced_values += changed
+        self.__output.append(json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        self.__output.append(b"\n")
+
+    # Gives the held back action the _index and _id of the document, before its values are coerced
+    def __target(self, document):
+        action, line = self.__action
+        op, meta = next(iter(action.items()))
+        index = meta.get("_index", self.__default_index)
+        if self.__router is not None and index is not None:
+            meta["_index"] = self.__router.target(index, document or {})
+            self.indices[meta["_index"]] = index
+        if document_ids is not None and document is not None and "_id" not in meta and op in ("index", "create"):
+            meta["_id"] = document_id(document)
+            if document_ids == "create" and op == "index":
+                self.__action = ({"create": meta}, line)
+        self.__field_types = self.__field_types_of(meta.get("_index", index)) if self.__field_types_of is not None else None
+
+    # Writes the held back action, returns False if the document is a duplicate to leave out. The
+    # fingerprint is taken from the document as sent, as Deduplicator.settle() takes it again.
+    def __write_action(self, document):
+        action, line = self.__action
+        self.__action = None
+        op, meta = next(iter(action.items()))
+        index = meta.get("_index", self.__default_index)
+        if (self.__deduplicator is not None and document is not None and op in ("index", "create")
+                and self.__deduplicator.duplicate(index, document, self.pending) is not None):
+            self.dropped.append((self.items - 1, {op: {"_index": index, "_type": meta.get("_type"),
+                                                       "_id": meta.get("_id"), "result": "noop", "status": 200}}))
+            return False
+        self.__output.append(json.dumps(action, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        self.__output.append(b"\n")
+        return True
+
+
+# 16 byte blake2b digest of a list of JSON values
+def _fingerprint(values):
+    key = json.dumps(values, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(key.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+
+# _id of a document: its document_id_fields hashed (see document_ids)
+def document_id(document):
+    return base64.urlsafe_b64encode(_fingerprint([document.get(field) for field in document_id_fields])).rstrip(b"=").decode()
+
+
+# Scalable Bloom filter (Almeida et al.) of 16 byte digests: a series of Bloom filters, each with
+# twice the capacity and half the error rate of the one before, so the error rate over all stays
+# below error_rate however many digests come. The bit positions are derived from the two halves of
+# a digest (double hashing). Once the next filter would not fit into max_bytes, new filters take
+# the capacity and error rate of the last one and the oldest filters are dropped, their digests
+# forgotten, so the error rate stays where it is.
+class ScalableBloomFilter:
+
+    __MAGIC = b"PSB1"
+    __HEADER = struct.Struct("<4sQI")
+    __LAYER = struct.Struct("<dQQIQ")
+    __MIN_ERROR = 1e-12
+
+    def __init__(self, error_rate, capacity, max_bytes):
+        self.__error_rate = error_rate
+        self.__capacity = capacity
+        self.__max_bytes = max_bytes
+        self.__layers = [] # {"bits": bytearray, "hashes": k, "error": rate, "capacity": digests, "count": digests added}
+        self.__full = False # max_bytes reached, logged once
+        self.forgotten = 0
+
+    def size(self):
+        return sum(len(layer["bits"]) for layer in self.__layers)
+
+    def count(self):
+        return sum(layer["count"] for layer in self.__layers)
+
+    # True if the digest was (probably) added
+    def __contains__(self, digest):
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        for layer in self.__layers:
+            bits = layer["bits"]
+            size = len(bits) << 3
+            for i in range(layer["hashes"]):
+                position = (h1 + i * h2) % size
+                if not bits[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    # Adds the digest, returns False if it was (probably) added before
+    def add(self, digest):
+        if digest in self:
+            return False
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        if not self.__layers or self.__layers[-1]["count"] >= self.__layers[-1]["capacity"]:
+            self.__grow()
+        layer = self.__layers[-1]
+        bits = layer["bits"]
+        size = len(bits) << 3
+        for i in range(layer["hashes"]):
+            position = (h1 + i * h2) % size
+            bits[position >> 3] |= 1 << (position & 7)
+        layer["count"] += 1
+        return True
+
+    @staticmethod
+    def __layer_size(capacity, error):
+        return (math.ceil(capacity * -math.log(error) / math.log(2) ** 2) + 7) // 8
+
+    def __grow(self):
+        if not self.__layers:
+            capacity, error = self.__capacity, self.__error_rate / 2
+        else:
+            capacity, error = self.__layers[-1]["capacity"], self.__layers[-1]["error"]
+            if not self.__full:
+                capacity, error = capacity * 2, max(error / 2, self.__MIN_ERROR)
+        # At most a quarter of max_bytes
+        capacity = max(1, min(capacity, int(self.__max_bytes * 2 * math.log(2) ** 2 / -math.log(error))))
+        size = self.__layer_size(capacity, error)
+        if self.__layers and self.size() + size > self.__max_bytes and not self.__full:
+            # Stop tightening: the new filter is like the last one, and so are those after it
+            self.__full = True
+            capacity, error = self.__layers[-1]["capacity"], self.__layers[-1]["error"]
+            size = self.__layer_size(capacity, error)
+            log.warning("Dedupe filter at its %.0f MB limit, forgetting the oldest fingerprints from now on",
+                        self.__max_bytes / 1048576)
+        while self.__layers and self.size() + size > self.__max_bytes:
+            self.forgotten += self.__layers.pop(0)["count"]
+        self.__layers.append({"bits": bytearray(size), "hashes": math.ceil(-math.log2(error)), "error": error,
+                              "capacity": capacity, "count": 0})
+
+    def save(self, path):
+        with open("%s.%d" % (path, os.getpid()), "wb") as filter_file:
+            filter_file.write(self.__HEADER.pack(self.__MAGIC, self.forgotten, len(self.__layers)))
+            for layer in self.__layers:
+                filter_file.write(self.__LAYER.pack(layer["error"], layer["capacity"], layer["count"], layer["hashes"], len(layer["bits"])))
+                filter_file.write(layer["bits"])
+        os.replace("%s.%d" % (path, os.getpid()), path)
+
+    # Returns False if there is no such file
+    def load(self, path):
+        try:
+            with open(path, "rb") as filter_file:
+                magic, forgotten, layer_count = self.__HEADER.unpack(filter_file.read(self.__HEADER.size))
+                if magic != self.__MAGIC:
+                    raise ValueError("not a dedupe filter")
+                layers = []
+                for _ in range(layer_count):
+                    error, capacity, count, hashes, size = self.__LAYER.unpack(filter_file.read(self.__LAYER.size))
+                    bits = bytearray(filter_file.read(size))
+                    if len(bits) != size:
+                        raise ValueError("truncated")
+                    layers.append({"bits": bits, "hashes": hashes, "error": error, "capacity": capacity, "count": count})
+        except FileNotFoundError:
+            return False
+        self.__layers = layers
+        self.forgotten = forgotten
+        return True
+
+
+# Dedupe stage of the _bulk documents (see dedupe), with its outcomes per index. A fingerprint is
+# pending while its document is on its way to ES and only recorded once ES took the document, so
+# a rerun sends again what ES rejected or never got.
+class Deduplicator:
+
+    def __init__(self):
+        self.__filter = ScalableBloomFilter(dedupe_error_rate, dedupe_capacity, dedupe_max_bytes)
+        self.__recent = collections.OrderedDict() # digest -> None, least recently seen first
+        self.__pending = set() # digests of the documents sent, but not yet answered by ES
+        self.__stats = {} # index -> {"kept": documents, "exact": duplicates, "probable": duplicates}
+
+    def load(self, path):
+        try:
+            if self.__filter.load(path):
+                log.info("Dedupe filter %s: %d fingerprints, %.1f MB", path, self.__filter.count(), self.__filter.size() / 1048576)
+        except (OSError, ValueError, struct.error) as e:
+            log.warning("Cannot read the dedupe filter %s, starting empty: %s", path, e)
+
+    def save(self, path):
+        try:
+            self.__filter.save(path)
+        except OSError as e:
+            log.error("Cannot save the dedupe filter %s: %s", path, e)
+
+    def stats(self):
+        return dict((index, dict(outcomes)) for index, outcomes in self.__stats.items())
+
+    def report(self):
+        for index, outcomes in sorted(self.__stats.items()):
+            dropped = outcomes["exact"] + outcomes["probable"]
+            log.info("Dedupe %s: %d documents, %d duplicates dropped (%d exact, %d probable)", index,
+                     outcomes["kept"] + dropped, dropped, outcomes["exact"], outcomes["probable"])
+
+    # None if the document of 'index' is new, its fingerprint then appended to 'pending', else
+    # "exact" or "probable"
+    def duplicate(self, index, document, pending):
+        digest = _fingerprint([index] + [document.get(field) for field in dedupe_fields])
+        outcomes = self.__stats.get(index)
+        if outcomes is None:
+            outcomes = self.__stats[index] = {"kept": 0, "exact": 0, "probable": 0}
+        if digest in self.__recent:
+            self.__recent.move_to_end(digest)
+            outcome = "exact"
+        elif digest in self.__pending:
+            outcome = "exact"
+        elif digest in self.__filter:
+            outcome = "probable"
+        else:
+            self.__pending.add(digest)
+            pending.append(digest)
+            outcome = None
+        outcomes[outcome or "kept"] += 1
+        return outcome
+
+    # Lets go of pending fingerprints whose documents are not sent after all
+    def release(self, digests):
+        self.__pending.difference_update(digests)
+
+    # Records the fingerprints of the documents of an exchanged _bulk request ES took, and drops
+    # those of the others from the pending ones. 'response' is None if the exchange failed.
+    def settle(self, request, response):
+        items = split_bulk_items(request.decoded_body())
+        statuses = None
+        if response is not None and response.status == 200:
+            body = response.decoded_body()
+            if _NO_ERRORS_PATTERN.search(body) is not None:
+                statuses = [200] * len(items)
+            else:
+                response_items = json.loads(body).get("items", [])
+                if len(response_items) == len(items):
+                    statuses = [_item_status(item) for item in response_items]
+        default_index = request.path[:-len("_bulk")].strip("/") or None
+        for position, (action, data) in enumerate(items):
+            op, meta = next(iter(action.items()), (None, None))
+            if op not in ("index", "create") or not isinstance(meta, dict):
+                continue
+            try:
+                document = json.loads(data[data.index(b"\n") + 1:])
+            except ValueError:
+                continue
+            if not isinstance(document, dict):
+                continue
+            digest = _fingerprint([meta.get("_index", default_index)] + [document.get(field) for field in dedupe_fields])
+            self.__pending.discard(digest)
+            if statuses is not None and 200 <= statuses[position] < 300:
+                self.__filter.add(digest)
+                self.__recent[digest] = None
+                self.__recent.move_to_end(digest)
+                if len(self.__recent) > dedupe_recent_keys:
+                    self.__recent.popitem(last=False)
+
+
+deduplicator = None # Deduplicator while dedupe is on, see serve_async_proxy()
+
+
+# Field types learned from mapper_parsing_exception rejections, per index (see mapping_learning).
+# field_types() is the coercion table of an index: the putmappingbody fields and those learned.
+class FieldTypeCache:
+
+    __REASON_PATTERN = re.compile(r"failed to parse (?:field )?\[([^\].]+)\](?: of type \[([^\]]+)\])?")
+
+    def __init__(self):
+        self.__learned = {} # index -> {field: type}
+        self.__tables = {} # index -> field type table
+
+    def load(self, path):
+        try:
+            with open(path) as cache_file:
+                self.__learned = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning("Cannot read the mapping cache %s: %s", path, e)
+            return
+        self.__tables.clear()
+        log.info("Mapping cache %s: %d learned field types of %d indices", path,
+                 sum(len(fields) for fields in self.__learned.values()), len(self.__learned))
+
+    # Merges into what the file holds, as the workers of --workers share it
+    def save(self, path):
+        try:
+            with open(path) as cache_file:
+                learned = json.load(cache_file)
+        except (OSError, ValueError):
+            learned = {}
+        for index, fields in self.__learned.items():
+            learned.setdefault(index, {}).update(fields)
+        with open("%s.%d" % (path, os.getpid()), "w") as cache_file:
+            json.dump(learned, cache_file, indent=2, sort_keys=True)
+        os.replace("%s.%d" % (path, os.getpid()), path)
+
+    def field_types(self, index):
+        table = self.__tables.get(index)
+        if table is None:
+            table = compile_field_types(putmappingbody)
+            if index in self.__learned:
+                table = dict(table)
+                table.update(self.__learned[index])
+            self.__tables[index] = table
+        return table
+
+    # Mapping body of an index: putmappingbody with the learned fields
+    def mapping(self, index):
+        if index not in self.__learned:
+            return putmappingbody
+        mapping = json.loads(putmappingbody)
+        for field, field_type in self.__learned[index].items():
+            mapping.setdefault("properties", {})[field] = {"type": field_type}
+            mapping["properties"][field + coerce_invalid_suffix] = {"type": "text"}
+        return json.dumps(mapping)
+
+    # Learns the types of the fields behind the mapper_parsing_exception items of a _bulk response
+    # and rewrites the request items concerned in place. Returns the positions of the items that
+    # changed, i.e. are worth sending again.
+    async def resolve(self, upstream, items, response_items):
+        misfits = {} # position -> (index, field, type or None)
+        for i, item in enumerate(response_items):
+            meta = next(iter(item.values()))
+            error = meta.get("error")
+            if meta.get("status") == 400 and isinstance(error, dict) and error.get("type") == "mapper_parsing_exception":
+                match = self.__REASON_PATTERN.search(error.get("reason", ""))
+                if match is not None:
+                    misfits[i] = (meta.get("_index"), match.group(1), match.group(2))
+
+        learned = {}
+        for index, field, field_type in set(misfits.values()):
+            if (index, field) not in learned:
+                if field_type is None:
+                    field_type = await self.__mapped_type(upstream, index, field)
+                if field_type in _COERCERS:
+                    learned[(index, field)] = field_type
+
+        changed = sorted(set(index for (index, field), field_type in learned.items()
+                             if self.__learned.get(index, {}).get(field) != field_type))
+        for (index, field), field_type in learned.items():
+            if self.__learned.get(index, {}).get(field) != field_type:
+                log.warning("Field %s of index %s is mapped as %s, coercing its values from now on", field, index, field_type)
+                self.__learned.setdefault(index, {})[field] = field_type
+                self.__tables.pop(index, None)
+        if changed and mapping_cache_file is not None:
+            self.save(mapping_cache_file)
+        for index in changed:
+            try:
+                report_mapping_response(index, await upstream.exchange(mapping_request(index)))
+            except (OSError, HttpFramingError) as e:
+                log.error("Mapping update failed for %s: %s", index, e)
+
+        rewritten = []
+        for i, (index, field, field_type) in misfits.items():
+            if (index, field) not in learned:
+                continue
+            action_line, source = items[i][1].rstrip(b"\n").split(b"\n", 1)
+            try:
+                document = json.loads(source)
+            except ValueError:
+                continue
+            if isinstance(document, dict) and coerce_document(document, self.field_types(index)) > 0:
+                items[i] = (items[i][0], action_line + b"\n" + json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n")
+                rewritten.append(i)
+        return rewritten
+
+    async def __mapped_type(self, upstream, index, field):
+        request = HttpRequest("GET", "/%s/_mapping/field/%s" % (index, field), "HTTP/1.1",
+                              [("Host", "%s:%d" % (target_elastic_host, target_elastic_port))])
+        try:
+            response = await upstream.exchange(request)
+            if response.status != 200:
+                return None
+            pending = [json.loads(response.decoded_body())]
+        except (OSError, HttpFramingError, ValueError):
+            return None
+        while pending: # {index: {"mappings": [{type}:] {field: {"mapping": {field: {"type": ...}}}}}}
+            node = pending.pop()
+            if isinstance(node, dict):
+                if isinstance(node.get("mapping"), dict) and isinstance(node["mapping"].get(field), dict):
+                    return node["mapping"][field].get("type")
+                pending.extend(node.values())
+        return None
+
+
+field_type_cache = FieldTypeCache()
+
+
+def mapping_request(index_name):
+    request = HttpRequest("PUT", "/" + index_name + "/_mapping/" + document_name, "HTTP/1.1",
+                          [("Host", "127.0.0.1:" + str(proxy_listening_port)), ("Accept-Encoding", "identity"),
+                           ("connection", "keep-alive"), ("content-type", "application/json")])
+    request.set_body(field_type_cache.mapping(index_name).encode())
+    return request
+
+
+# Keeps the mapping registered as index template (see index_template). 'installed' tells the
+# relays whether they can skip the interception.
+class IndexTemplate:
+
+    def __init__(self, upstream):
+        self.__upstream = upstream
+        self.installed = False
+
+    def __path(self):
+        if index_template == "composable":
+            return "/_index_template/" + index_template_name
+        return "/_template/" + index_template_name
+
+    def __body(self):
+        mapping = json.loads(putmappingbody)
+        if index_template == "composable":
+            return {"index_patterns": [index_template_pattern], "template": {"mappings": mapping}}
+        return {"index_patterns": [index_template_pattern], "mappings": {document_name: mapping}}
+
+    def __registered(self, response):
+        if response.status != 200:
+            return False
+        document = json.loads(response.decoded_body())
+        if index_template == "composable":
+            templates = [template["index_template"] for template in document.get("index_templates", [])]
+        else:
+            templates = list(document.values())
+        return any(template.get("index_patterns") == [index_template_pattern] for template in templates)
+
+    async def verify(self):
+        headers = [("Host", "127.0.0.1:" + str(proxy_listening_port)), ("Accept-Encoding", "identity"),
+                   ("connection", "keep-alive"), ("content-type", "application/json")]
+        try:
+            if self.__registered(await self.__upstream.exchange(HttpRequest("GET", self.__path(), "HTTP/1.1", headers))):
+                self.installed = True
+                return
+            request = HttpRequest("PUT", self.__path(), "HTTP/1.1", headers)
+            request.set_body(json.dumps(self.__body()).encode())
+            response = await self.__upstream.exchange(request)
+        except (OSError, HttpFramingError, ValueError) as e:
+            log.warning("Index template %s not verified: %s", index_template_name, e)
+            self.installed = False
+            return
+
+        self.installed = 200 <= response.status < 300
+        if self.installed:
+            log.info("Index template %s installed for %s", index_template_name, index_template_pattern)
+        else:
+            log.warning("Index template %s rejected, intercepting index creations: %s", index_template_name, response.describe())
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(index_template_verify_interval)
+            await self.verify()
+
+
+# Indices under the bulk-load profile (see bulk_profile), with the connections writing to them
+class BulkLoadProfile:
+
+    def __init__(self, upstream):
+        self.__upstream = upstream
+        self.__indices = {} # index -> {"restore": settings or None, "connections": set, "last_bulk": time, "ready": future}
+        self.__task = None
+        self.__restores = set()
+        self.__merges = set()
+
+    def start(self):
+        self.__task = asyncio.ensure_future(self.__watch())
+
+    # Restores all indices, as the proxy stops
+    async def close(self):
+        self.__task.cancel()
+        for index in list(self.__indices):
+            await self.__finish(index)
+        for restore in list(self.__restores): # started by __watch before it was cancelled
+            await restore
+        for merge in self.__merges:
+            merge.cancel()
+
+    # The index is being written to by the connection; the profile is applied first if it is not
+    async def attach(self, index, connection):
+        entry = self.__indices.get(index)
+        if entry is None:
+            entry = self.__indices[index] = {"restore": None, "connections": set(), "last_bulk": time.monotonic(),
+                                             "ready": asyncio.ensure_future(self.__apply(index))}
+        entry["connections"].add(connection)
+        entry["last_bulk"] = time.monotonic()
+        await asyncio.shield(entry["ready"])
+
+    def detach(self, connection):
+        for entry in self.__indices.values():
+            if connection in entry["connections"]:
+                entry["connections"].discard(connection)
+                entry["closed"] = time.monotonic()
+
+    # Keeps the settings the profile overrides, null for those at their default or already at their
+    # bulk-load value, which the index cannot have had before, and applies it. Unless both succeed,
+    # the index is left as it is and nothing is restored later.
+    async def __apply(self, index):
+        entry = self.__indices[index]
+        try:
+            response = await self.__upstream.exchange(json_request("GET", "/%s/_settings?flat_settings=true" % index))
+            current = self.__current_settings(response) if response.status == 200 else None
+            if current is None:
+                log.warning("Bulk-load settings not applied to %s, its settings are unknown: %s", index, response.describe())
+                return
+            response = await self.__upstream.exchange(json_request("PUT", "/%s/_settings" % index, bulk_load_settings))
+        except (OSError, HttpFramingError) as e:
+            log.warning("Bulk-load settings not applied to %s: %s", index, e)
+            return
+        if response.status == 200:
+            entry["restore"] = dict((name, None if str(current.get(name)) == str(value) else current.get(name))
+                                    for name, value in bulk_load_settings.items())
+            log.info("Bulk-load settings applied to %s", index)
+        else:
+            log.warning("Bulk-load settings rejected for %s: %s", index, response.describe())
+
+    def __current_settings(self, response):
+        try:
+            settings = next(iter(json.loads(response.decoded_body()).values())).get("settings", {})
+            return dict((name, settings[name]) for name in bulk_load_settings if name in settings)
+        except (ValueError, AttributeError, StopIteration):
+            return None
+
+    async def __watch(self):
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for index, entry in list(self.__indices.items()):
+                if not entry["connections"] and now - entry.get("closed", now) >= bulk_profile_close_delay:
+                    log.info("No more connections write to %s", index)
+                elif now - entry["last_bulk"] >= bulk_profile_idle_time:
+                    log.info("No _bulk request for %s since %.0f s", index, now - entry["last_bulk"])
+                else:
+                    continue
+                await self.__finish(index)
+
+    # Restores the index in a task of its own, which cancelling __watch does not stop
+    async def __finish(self, index):
+        restore = asyncio.ensure_future(self.__restore(index, self.__indices.pop(index)))
+        self.__restores.add(restore)
+        restore.add_done_callback(self.__restores.discard)
+        await asyncio.shield(restore)
+
+    async def __restore(self, index, entry):
+        await asyncio.shield(entry["ready"])
+        if entry["restore"] is None:
+            return
+        try:
+            response = await self.__upstream.exchange(json_request("PUT", "/%s/_settings" % index, entry["restore"]))
+            if response.status != 200:
+                log.warning("Settings of %s not restored: %s", index, response.describe())
+                return
+            await self.__upstream.exchange(json_request("POST", "/%s/_refresh" % index))
+        except (OSError, HttpFramingError) as e:
+            log.warning("Settings of %s not restored: %s", index, e)
+            return
+        log.info("Settings of %s restored and index refreshed", index)
+        if bulk_profile_forcemerge is not None:
+            merge = asyncio.ensure_future(self.__forcemerge(index))
+            self.__merges.add(merge)
+            merge.add_done_callback(self.__merges.discard)
+
+    async def __forcemerge(self, index):
+        log.info("Force merging %s to %d segments", index, bulk_profile_forcemerge)
+        try:
+            response = await self.__upstream.exchange(json_request(
+                "POST", "/%s/_forcemerge?max_num_segments=%d" % (index, bulk_profile_forcemerge)))
+        except (OSError, HttpFramingError) as e:
+            log.warning("Force merge of %s failed: %s", index, e)
+            return
+        if response.status == 200:
+            log.info("Force merge of %s done", index)
+        else:
+            log.warning("Force merge of %s failed: %s", index, response.describe())
+
+
+# Target indices of the documents (see index_routing_time), created on first use
+class IndexRouter:
+
+    __TIME_PARTS = {"year": 1, "month": 2, "day": 3}
+    __INVALID_NAME_PATTERN = re.compile(r"[^a-z0-9_.+]+")
+
+    def __init__(self, upstream):
+        self.__upstream = upstream
+        self.__created = {} # index -> future of its creation
+        self.__names = {} # index_routing_field value -> index name part
+
+    def creation_response(self, index_name):
+        log.info("Index %s is routed, answering its creation", index_name)
+        return json_response(200, {"acknowledged": True, "shards_acknowledged": True, "index": index_name})
+
+    # Index of a document psort sends to 'index'
+    def target(self, index, document):
+        parts = [index]
+        if index_routing_time is not None:
+            parts.append(self.__bucket(document))
+        if index_routing_field is not None:
+            value = document.get(index_routing_field)
+            name = self.__names.get(value) if isinstance(value, str) else None
+            if name is None:
+                name = self.__INVALID_NAME_PATTERN.sub("_", str(value).lower()).strip("_.")[:64] if value is not None else ""
+                name = name or "none"
+                if isinstance(value, str) and len(self.__names) < 10000:
+                    self.__names[value] = name
+            parts.append(name)
+        return "-".join(parts)
+
+    def __bucket(self, document):
+        value = document.get("datetime")
+        if isinstance(value, str) and _DATE_PATTERN.match(value):
+            date = (value[0:4], value[5:7], value[8:10])
+        else:
+            timestamp = document.get("timestamp")
+            if type(timestamp) is not int or timestamp <= 0:
+                return "undated"
+            try:
+                date = tuple(time.strftime("%Y %m %d", time.gmtime(timestamp // 1000000)).split())
+            except (OverflowError, OSError, ValueError):
+                return "undated"
+        return ".".join(date[:self.__TIME_PARTS[index_routing_time]])
+
+    # Creates the indices not created yet, {index: alias}
+    async def ensure(self, indices):
+        pending = []
+        for index, alias in indices.items():
+            creation = self.__created.get(index)
+            if creation is None:
+                creation = self.__created[index] = asyncio.ensure_future(self.__create(index, alias))
+            pending.append(creation)
+        for creation in pending:
+            await asyncio.shield(creation)
+
+    # Creates the index with its mapping and alias in one request, so no document reaches it
+    # before the mapping, e.g. from another worker. Failed creations are tried again with the
+    # next document for the index.
+    async def __create(self, index, alias):
+        creation = {"aliases": {alias: {}}, "mappings": {document_name: json.loads(field_type_cache.mapping(index))}}
+        try:
+            response = await self.__upstream.exchange(json_request("PUT", "/" + index, creation))
+            if response.status == 400 and b"already_exists_exception" in response.decoded_body():
+                # Created by an earlier run or another worker, with the mapping
+                response = await self.__upstream.exchange(json_request("POST", "/_aliases", {"actions": [{"add": {"index": index, "alias": alias}}]}))
+                if response.status != 200:
+                    log.warning("Alias %s not added to %s: %s", alias, index, response.describe())
+                    self.__created.pop(index, None)
+                return
+            if response.status != 200:
+                log.error("Routed index %s not created: %s", index, response.describe())
+                self.__created.pop(index, None)
+                return
+        except (OSError, HttpFramingError) as e:
+            log.error("Routed index %s not created: %s", index, e)
+            self.__created.pop(index, None)
+            return
+        log.info("Routed index %s created with the mapping, alias %s", index, alias)
+
+
+# Index a _bulk request writes to: that of its path, else that of its first action
+def bulk_request_index(request):
+    index = request.path[:-len("_bulk")].strip("/")
+    if index:
+        return index
+    body = request.decoded_body()
+    try:
+        action = json.loads(body[:body.find(b"\n")] if b"\n" in body else body)
+        return next(iter(action.values())).get("_index")
+    except (ValueError, AttributeError, StopIteration):
+        return None
+
 
-signal_term_proxy = False
+# Options of the stages that make the asyncio engine look at the requests. Without any, a
+# connection is relayed byte for byte once the index template is in place.
+def http_stages():
+    stages = [("--coerce", bulk_coerce_values), ("--rebatch", bulk_rebatch), ("retries (--no-retry)", bulk_retry_rejected),
+              ("--journal", journal_directory is not None), ("--fanout", bulk_fanout > 1), ("--bulk-profile", bulk_profile),
+              ("--route-time/--route-by", index_routing_time is not None or index_routing_field is not None),
+              ("--stable-ids", document_ids is not None), ("--dedupe", dedupe), ("--compress", upstream_compression is not None)]
+    return [option for option, enabled in stages if enabled]
+
+
+def http_stages_enabled():
+    return len(http_stages()) > 0
+
+
+def report_mapping_response(index_name, response):
+    try:
+        acknowledged = 200 <= response.status < 300 and json.loads(response.decoded_body()).get("acknowledged", False)
+    except ValueError:
+        acknowledged = False
+    if acknowledged:
+        log.info("Mapping acknowledged for %s", index_name)
+    else:
+        log.error("Mapping rejected for %s: %s", index_name, response.describe())
+
+
+def json_response(status, document):
+    response = HttpResponse("HTTP/1.1", status, HTTPStatus(status).phrase,
+                            [("content-type", "application/json; charset=UTF-8")])
+    response.set_body(json.dumps(document).encode())
+    return response
+
+
+def error_response(status, error_type, reason):
+    return json_response(status, {"error": {"type": error_type, "reason": reason}, "status": status})
+
+
+# _bulk response with the items of the documents the dedupe stage left out of the request put
+# back in place (see BulkRewriter.dropped)
+def restore_dropped_items(response, rewriter):
+    if response.status != 200:
+        return response
+    document = json.loads(response.decoded_body())
+    items = document.get("items", [])
+    if len(items) + len(rewriter.dropped) != rewriter.items:
+        return response
+    for position, item in rewriter.dropped:
+        items.insert(position, item)
+    document["items"] = items
+    return json_response(200, document)
+
+
+# Request of the proxy itself to ES, with a JSON body if 'document' is given
+def json_request(method, target, document=None):
+    request = HttpRequest(method, target, "HTTP/1.1", [("Host", "127.0.0.1:" + str(proxy_listening_port)),
+                                                       ("Accept-Encoding", "identity"), ("content-type", "application/json")])
+    if document is not None:
+        request.set_body(json.dumps(document).encode())
+    return request
+
+
+# Answer to a _bulk request whose documents the proxy took over (re-batching, journal): every
+# item is acknowledged with status 202
+def queued_bulk_response(request, items):
+    default_index = request.path[:-len("_bulk")].strip("/") or None
+    return json_response(200, {"took": 0, "errors": False, "items": [
+        {op: {"_index": meta.get("_index", default_index), "_type": meta.get("_type"), "_id": meta.get("_id"),
+              "status": 202, "result": "queued"}}
+        for action in (item[0] for item in items) for op, meta in action.items()]})
+
+
+# Logs the outcome of a _bulk request the proxy sent on its own, since psort never sees it.
+# Without 'documents', they are counted in the response.
+def report_bulk_response(what, response, documents=None):
+    if response.status != 200:
+        log.error("%s failed: %s", what if documents is None else "%s of %d documents" % (what, documents), response.describe())
+        return
+    items = json.loads(response.decoded_body()).get("items", [])
+    documents = len(items) if documents is None else documents
+    failed = [item for item in items if next(iter(item.values())).get("status", 200) >= 300]
+    metrics.observe_bulk_items(documents, len(failed))
+    if failed:
+        log.warning("%s: %d of %d documents rejected, first: %s", what, len(failed), documents, json.dumps(failed[0]))
+
+
+# Items of a _bulk body as (action, bytes) pairs, the bytes holding the action line and, but
+# for delete, the source line.
+def split_bulk_items(body):
+    items = []
+    lines = body.split(b"\n")
+    if lines and lines[-1] == b"":
+        lines.pop()
+    i = 0
+    while i < len(lines):
+        if not lines[i].strip():
+            i += 1
+            continue
+        try:
+            action = json.loads(lines[i])
+        except ValueError:
+            action = {}
+        count = 1 if "delete" in action else 2
+        items.append((action, b"\n".join(lines[i:i + count]) + b"\n"))
+        i += count
+    return items
+
+
+# Single _bulk response for the items of several requests, in order
+def merge_bulk_responses(responses):
+    took = 0
+    errors = False
+    items = []
+    for response in responses:
+        document = json.loads(response.decoded_body())
+        took += document.get("took", 0)
+        errors = errors or document.get("errors", False)
+        items.extend(document.get("items", []))
+    return json_response(200, {"took": took, "errors": errors, "items": items})
+
+
+_REJECTED_ITEM_PATTERN = re.compile(rb'"status"\s*:\s*429\b')
+_CONFLICT_ITEM_PATTERN = re.compile(rb'"status"\s*:\s*409\b')
+_NO_ERRORS_PATTERN = re.compile(rb'"errors"\s*:\s*false\b')
+
+
+def _item_status(item):
+    return next(iter(item.values())).get("status", 200)
+
+
+# Exchanges a _bulk request, re-sends the items rejected for a field type ES learned from an
+# earlier document once the type is learned (see mapping_learning) and retries the items ES
+# rejects with 429 (see bulk_retry_rejected). create items of documents already indexed become
+# no-ops (see document_ids). Responses without such items are returned as they are, without
+# being parsed.
+async def _exchange_bulk(upstream, request):
+    response = await upstream.exchange(request)
+    if response.status != 200:
+        return response
+    body = response.decoded_body()
+    rejected = bulk_retry_rejected and _REJECTED_ITEM_PATTERN.search(body) is not None
+    misfit = mapping_learning and bulk_coerce_values and b"mapper_parsing_exception" in body
+    existing = document_ids == "create" and _CONFLICT_ITEM_PATTERN.search(body) is not None
+    if not rejected and not misfit and not existing:
+        return response
+
+    document = json.loads(body)
+    items = split_bulk_items(request.decoded_body())
+    if len(items) != len(document.get("items", [])):
+        return response
+
+    if misfit:
+        rewritten = await field_type_cache.resolve(upstream, items, document["items"])
+        if rewritten:
+            await _resend_items(upstream, request, items, rewritten, document)
+            log.info("Re-sent %d documents with coerced values, %d still rejected", len(rewritten),
+                     sum(1 for i in rewritten if _item_status(document["items"][i]) >= 300))
+
+    retried = [i for i, item in enumerate(document["items"]) if _item_status(item) == 429] if bulk_retry_rejected else []
+    pending = retried
+    for attempt in range(bulk_retry_attempts):
+        if not pending:
+            break
+        await asyncio.sleep(random.uniform(0, min(bulk_retry_delay * 2 ** attempt, bulk_retry_max_delay)))
+        await _resend_items(upstream, request, items, pending, document)
+        pending = [i for i in pending if _item_status(document["items"][i]) == 429]
+
+    if retried:
+        metrics.observe_bulk_retries(len(retried), len(pending))
+        log.log(logging.WARNING if pending else logging.DEBUG, "Retried %d of %d documents rejected with 429, %d still rejected",
+                len(retried), len(items), len(pending))
+    if document_ids == "create":
+        _existing_as_noop(document["items"])
+    document["errors"] = any(_item_status(item) >= 300 for item in document["items"])
+    return json_response(200, document)
+
+
+# Exchanges a _bulk request (see _exchange_bulk) and settles the dedupe fingerprints of its
+# documents with the outcome (see Deduplicator.settle)
+async def exchange_bulk(upstream, request):
+    if deduplicator is None:
+        return await _exchange_bulk(upstream, request)
+    try:
+        response = await _exchange_bulk(upstream, request)
+    except BaseException:
+        deduplicator.settle(request, None)
+        raise
+    deduplicator.settle(request, response)
+    return response
+
+
+# create items ES refused as the document exists, i.e. was indexed by an earlier run
+def _existing_as_noop(response_items):
+    existing = 0
+    for i, item in enumerate(response_items):
+        meta = item.get("create")
+        if meta is not None and meta.get("status") == 409 and (meta.get("error") or {}).get("type") == "version_conflict_engine_exception":
+            response_items[i] = {"create": {"_index": meta.get("_index"), "_type": meta.get("_type"), "_id": meta.get("_id"),
+                                            "result": "noop", "status": 200}}
+            existing += 1
+    if existing:
+        log.debug("%d documents already indexed", existing)
+
+
+# Exchanges a _bulk request in slices sent at the same time (see bulk_fanout). A slice ES does not
+# answer with 200 turns into failed items of the merged response, unless all of them fail.
+async def exchange_bulk_fanout(upstream, request):
+    body = request.decoded_body()
+    slice_count = min(bulk_fanout, len(body) // bulk_fanout_min_bytes)
+    if slice_count < 2:
+        return await exchange_bulk(upstream, request)
+    items = split_bulk_items(body)
+    ids = [meta.get("_id") for action in (item[0] for item in items) for meta in action.values()
+           if isinstance(meta, dict) and meta.get("_id") is not None]
+    if len(items) < slice_count or len(ids) != len(set(ids)):
+        return await exchange_bulk(upstream, request)
+
+    slices = [[]]
+    size = 0
+    for item in items:
+        if size >= len(body) * len(slices) / slice_count:
+            slices.append([])
+        slices[-1].append(item)
+        size += len(item[1])
+    headers = [header for header in request.headers if header[0].lower() != "content-encoding"]
+    sub_requests = []
+    for slice_items in slices:
+        sub_request = HttpRequest(request.method, request.target, request.version, list(headers))
+        sub_request.set_body(b"".join(item[1] for item in slice_items))
+        sub_requests.append(sub_request)
+
+    results = await asyncio.gather(*(exchange_bulk(upstream, sub_request) for sub_request in sub_requests), return_exceptions=True)
+    responses = []
+    for result in results:
+        if isinstance(result, (OSError, HttpFramingError)):
+            result = error_response(502, "proxy_exception", "Elasticsearch exchange failed: %s" % result)
+        elif isinstance(result, BaseException):
+            raise result
+        responses.append(result)
+    if all(response.status != 200 for response in responses):
+        return responses[0]
+    return merge_bulk_responses([response if response.status == 200 else _failed_items_response(request, slice_items, response)
+                                 for slice_items, response in zip(slices, responses)])
+
+
+# _bulk response failing every item with the status of an error response to their request
+def _failed_items_response(request, items, response):
+    default_index = request.path[:-len("_bulk")].strip("/") or None
+    reason = "Elasticsearch answered %d: %s" % (response.status, response.decoded_body()[:log_body_limit].decode("utf-8", "replace"))
+    return json_response(200, {"took": 0, "errors": True, "items": [
+        {op: {"_index": meta.get("_index", default_index), "_type": meta.get("_type"), "_id": meta.get("_id"),
+              "status": response.status, "error": {"type": "proxy_exception", "reason": reason}}}
+        for action in (item[0] for item in items) for op, meta in action.items()]})
+
+
+# Sends the items at 'positions' of a _bulk request again, in one request, and puts their
+# outcomes into the response 'document'
+async def _resend_items(upstream, request, items, positions, document):
+    retry_request = HttpRequest(request.method, request.target, request.version,
+                                [header for header in request.headers if header[0].lower() != "content-encoding"])
+    retry_request.set_body(b"".join(items[i][1] for i in positions))
+    try:
+        retry_response = await upstream.exchange(retry_request)
+    except (OSError, HttpFramingError) as e:
+        log.warning("Re-sending %d documents failed: %s", len(positions), e)
+        return
+    if retry_response.status != 200:
+        log.warning("Re-sending %d documents failed: %s", len(positions), retry_response.describe())
+        return
+
+    retry_document = json.loads(retry_response.decoded_body())
+    for i, item in zip(positions, retry_document.get("items", [])):
+        document["items"][i] = item
+    document["took"] = document.get("took", 0) + retry_document.get("took", 0)
+
+
+# Nothing was sent: the request can safely go to another node
+class UpstreamConnectError(ConnectionError):
+    pass
+
+
+# Keep-alive HTTP connection to ES used by the asyncio engine: exchange() sends one request and
+# returns the response to it. An idle connection closed by ES is reopened transparently.
+class UpstreamConnection:
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.__reader = None
+        self.__writer = None
+        self.__framer = None
+
+    def connected(self):
+        return self.__writer is not None
+
+    async def connect(self):
+        try:
+            self.__reader, self.__writer = await asyncio.open_connection(self.host, self.port)
+        except OSError as e:
+            raise UpstreamConnectError(*e.args)
+        self.__framer = HttpResponseFramer()
+
+    def close(self):
+        if self.__writer is not None:
+            self.__writer.close()
+        self.__reader = self.__writer = self.__framer = None
+
+    async def exchange(self, request):
+        reused = self.connected()
+        if not reused:
+            await self.connect()
+        try:
+            return await self.__exchange(request)
+        except (ConnectionError, HttpFramingError):
+            self.close()
+            if not reused:
+                raise
+        # The keep-alive connection went stale, one more try on a fresh one
+        await self.connect()
+        try:
+            return await self.__exchange(request)
+        except (ConnectionError, HttpFramingError):
+            self.close()
+            raise
+
+    async def __exchange(self, request):
+        self.__framer.expect(request.method)
+        self.__writer.writelines((request.head, request.body))
+        await self.__writer.drain()
+
+        while True:
+            data = await self.__reader.read(102400)
+            responses = self.__framer.feed(data) if data else self.__framer.feed_eof()
+            for response in responses:
+                if response.status >= 200: # skip 100 Continue
+                    if not data or not response.keep_alive():
+                        self.close()
+                    return response
+            if not data:
+                raise ConnectionError("ES closed the connection")
+
+
+def _compress(data, encoding):
+    wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+    compressor = zlib.compressobj(upstream_compression_level, zlib.DEFLATED, wbits)
+    return compressor.compress(data) + compressor.flush()
+
+
+# Copy of the request with its body upstream_compression encoded and gzip accepted. Large bodies are
+# compressed on the default executor: zlib releases the GIL, the event loop keeps relaying meanwhile.
+async def compress_request(request):
+    upstream_request = HttpRequest(request.method, request.target, request.version, list(request.headers))
+    upstream_request.set_body(request.body)
+    if "gzip" not in request.header("Accept-Encoding", "").lower():
+        upstream_request.set_header("Accept-Encoding", "gzip")
+    if len(request.body) >= upstream_compress_min_size and request.header("Content-Encoding") is None:
+        if len(request.body) >= 256 * 1024:
+            body = await asyncio.get_running_loop().run_in_executor(None, _compress, request.body, upstream_compression)
+        else:
+            body = _compress(request.body, upstream_compression)
+        upstream_request.headers.append(("Content-Encoding", upstream_compression))
+        upstream_request.set_body(body)
+    return upstream_request
+
+
+# The response as the client asked for it: decoded unless the client accepts its encoding
+def decompress_response(response, request):
+    encoding = response.header("Content-Encoding")
+    if encoding is None or encoding.lower() in request.header("Accept-Encoding", "").lower():
+        return response
+    body = response.decoded_body()
+    response.headers = [header for header in response.headers if header[0].lower() != "content-encoding"]
+    response.set_body(body)
+    return response
+
+
+class UpstreamNode:
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.idle = collections.deque()
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def available(self, now):
+        return self.ejected_until <= now
+
+
+# Pool of keep-alive upstream connections over the ES nodes (see target_elastic_nodes). Every
+# exchange goes to the available node with the fewest outstanding requests. A node that cannot be
+# connected to is ejected and the request tried on the next node; a node failing in the middle of
+# an exchange is ejected too, but the request is not repeated elsewhere as ES may have processed it.
+class UpstreamPool:
+
+    def __init__(self, nodes):
+        self.nodes = [UpstreamNode(host, port) for host, port in nodes]
+        self.__health_task = None
+
+    async def start(self):
+        for node in self.nodes:
+            log.info("Elasticsearch node %s", node)
+        await self.__check_nodes()
+        self.__health_task = asyncio.ensure_future(self.__health_loop())
+
+    def close(self):
+        if self.__health_task is not None:
+            self.__health_task.cancel()
+        for node in self.nodes:
+            while node.idle:
+                node.idle.pop().close()
+
+    async def exchange(self, request):
+        if upstream_compression is None:
+            return await self.__exchange(request)
+        response = await self.__exchange(await compress_request(request))
+        return decompress_response(response, request)
+
+    async def __exchange(self, request):
+        tried = set()
+        while True:
+            node = self.__select(tried)
+            connection = node.idle.pop() if node.idle else UpstreamConnection(node.host, node.port)
+            node.outstanding += 1
+            try:
+                response = await connection.exchange(request)
+            except UpstreamConnectError as e:
+                self.__eject(node, e)
+                tried.add(node)
+                if len(tried) == len(self.nodes):
+                    raise
+                continue
+            except (OSError, HttpFramingError) as e:
+                connection.close()
+                self.__eject(node, e)
+                raise
+            finally:
+                node.outstanding -= 1
+
+            node.failures = 0
+            if connection.connected() and len(node.idle) < upstream_pool_size:
+                node.idle.append(connection)
+            else:
+                connection.close()
+            return response
+
+    # Raw stream to the available node with the fewest outstanding requests, for passthrough relays
+    async def open_stream(self):
+        tried = set()
+        while True:
+            node = self.__select(tried)
+            try:
+                return await asyncio.open_connection(node.host, node.port)
+            except OSError as e:
+                self.__eject(node, e)
+                tried.add(node)
+                if len(tried) == len(self.nodes):
+                    raise
+
+    # Available node with the fewest outstanding requests, the node back first if all are ejected
+    def __select(self, tried):
+        now = time.monotonic()
+        candidates = [node for node in self.nodes if node not in tried and node.available(now)]
+        if not candidates:
+            candidates = sorted((node for node in self.nodes if node not in tried), key=lambda node: node.ejected_until)[:1]
+        return min(candidates, key=lambda node: (node.outstanding, random.random()))
+
+    def __eject(self, node, error):
+        node.failures += 1
+        eject_time = min(upstream_eject_time * 2 ** (node.failures - 1), upstream_eject_max_time)
+        node.ejected_until = time.monotonic() + eject_time
+        log.warning("Elasticsearch node %s ejected for %.0f s: %s", node, eject_time, error)
+
+    async def __health_loop(self):
+        while True:
+            await asyncio.sleep(upstream_health_interval)
+            await self.__check_nodes()
+
+    # Checks every node with GET / and tops its idle connections up to upstream_pool_size, so
+    # the first request of a psort run does not wait for a TCP connect
+    async def __check_nodes(self):
+        await asyncio.gather(*(self.__check_node(node) for node in self.nodes))
+
+    async def __check_node(self, node):
+        connection = node.idle.pop() if node.idle else UpstreamConnection(node.host, node.port)
+        try:
+            response = await asyncio.wait_for(connection.exchange(HttpRequest("GET", "/", "HTTP/1.1", [("Host", str(node))])),
+                                              upstream_health_interval)
+            if response.status >= 500:
+                raise ConnectionError("GET / answered %d" % response.status)
+        except (OSError, HttpFramingError, asyncio.TimeoutError) as e:
+            connection.close()
+            if node.available(time.monotonic()):
+                self.__eject(node, e)
+            return
+
+        if not node.available(time.monotonic()):
+            log.info("Elasticsearch node %s is back", node)
+        node.failures = 0
+        node.ejected_until = 0.0
+        node.idle.append(connection)
+        while len(node.idle) < upstream_pool_size:
+            connection = UpstreamConnection(node.host, node.port)
+            try:
+                await connection.connect()
+            except UpstreamConnectError:
+                break
+            node.idle.append(connection)
+
+
+# Re-batching stage of the asyncio engine, shared by all client connections (see bulk_rebatch).
+# Batches are kept per request target, so documents only get merged with documents sent to the
+# same _bulk endpoint with the same parameters.
+class BulkBatcher:
+
+    def __init__(self, upstream):
+        self.__upstream = upstream
+        self.__lock = asyncio.Lock()
+        self.__batches = {}
+        self.__timers = {}
+        self.__linger_tasks = set()
+
+    async def submit(self, request):
+        items = split_bulk_items(request.body)
+        if len(request.body) >= bulk_batch_bytes or len(items) >= bulk_batch_documents:
+            await self.flush() # keep the document order
+            return await self.__send_split(request, items)
+
+        batch = self.__batches.setdefault(request.target, (request, []))[1]
+        batch.extend(items)
+        memory_budget.add(sum(len(item[1]) for item in items))
+        ack = queued_bulk_response(request, items)
+
+        if (len(batch) >= bulk_batch_documents or sum(len(item[1]) for item in batch) >= bulk_batch_bytes
+                or memory_budget.exhausted()):
+            await self.__flush_target(request.target) # psort waits for full batches, that is the backpressure
+        elif request.target not in self.__timers:
+            self.__timers[request.target] = asyncio.get_running_loop().call_later(
+                bulk_batch_linger, self.__linger_expired, request.target)
+        return ack
+
+    async def flush(self):
+        for target in list(self.__batches):
+            await self.__flush_target(target)
+        if self.__linger_tasks:
+            await asyncio.gather(*self.__linger_tasks, return_exceptions=True)
+
+    def close(self):
+        for timer in self.__timers.values():
+            timer.cancel()
+
+    def __linger_expired(self, target):
+        task = asyncio.ensure_future(self.__flush_target(target))
+        self.__linger_tasks.add(task)
+        task.add_done_callback(self.__linger_tasks.discard)
+
+    async def __flush_target(self, target):
+        timer = self.__timers.pop(target, None)
+        if timer is not None:
+            timer.cancel()
+        async with self.__lock:
+            if target not in self.__batches:
+                return
+            request, items = self.__batches.pop(target)
+            response = await self.__send(self.__sub_request(request, items), attempts=3)
+            memory_budget.release(sum(len(item[1]) for item in items))
+            report_bulk_response("Bulk batch", response, len(items))
+
+    async def __send_split(self, request, items):
+        responses = []
+        async with self.__lock:
+            batch = []
+            batch_size = 0
+            for item in items + [None]:
+                if item is None or len(batch) >= bulk_batch_documents or batch_size + len(item[1]) > bulk_batch_bytes:
+                    if batch:
+                        response = await self.__send(self.__sub_request(request, batch), attempts=1)
+                        if response.status != 200:
+                            return response
+                        if metrics_port is not None:
+                            observe_bulk_response(response)
+                        responses.append(response)
+                    batch = []
+                    batch_size = 0
+                if item is not None:
+                    batch.append(item)
+                    batch_size += len(item[1])
+        return merge_bulk_responses(responses)
+
+    def __sub_request(self, request, items):
+        sub_request = HttpRequest(request.method, request.target, request.version, list(request.headers))
+        sub_request.set_body(b"".join(item[1] for item in items))
+        return sub_request
+
+    async def __send(self, request, attempts):
+        for attempt in range(attempts):
+            try:
+                return await exchange_bulk(self.__upstream, request)
+            except (OSError, HttpFramingError) as e:
+                log.warning("Bulk batch: ES not reachable: %s", e)
+                await asyncio.sleep(attempt + 1)
+        return error_response(502, "proxy_exception", "Elasticsearch not reachable")
+
+
+# Kernel relay of the thread engine: data moves from one socket to the other through a pipe per
+# direction with splice(), without being copied into Python. 'pending' holds the bytes waiting in
+# the up and down pipes. Returns when one side closed the connection and what it sent is passed on.
+def splice_relay(client_socket, target_socket, pending):
+    directions = []
+    for source, destination in ((client_socket, target_socket), (target_socket, client_socket)):
+        pipe_read, pipe_write = os.pipe()
+        try:
+            fcntl.fcntl(pipe_write, fcntl.F_SETPIPE_SZ, relay_splice_size)
+        except (OSError, AttributeError):
+            pass # the pipe keeps the default 64 KB
+        directions.append((source, destination, pipe_read, pipe_write))
+    pipe_size = fcntl.fcntl(directions[0][3], fcntl.F_GETPIPE_SZ) if hasattr(fcntl, "F_GETPIPE_SZ") else 65536
+    flags = os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK
+    closed = [False, False]
+
+    try:
+        while not signal_term_proxy and not any(closed[i] and pending[i] == 0 for i in range(2)):
+            inputs = [direction[0] for i, direction in enumerate(directions) if pending[i] < pipe_size and not closed[i]]
+            outputs = [direction[1] for i, direction in enumerate(directions) if pending[i] > 0]
+            inputs_ready, outputs_ready, errors_ready = select.select(inputs, outputs, [], 1.0)
+
+            for i, (source, destination, pipe_read, pipe_write) in enumerate(directions):
+                if source in inputs_ready:
+                    try:
+                        count = os.splice(source.fileno(), pipe_write, pipe_size - pending[i], flags=flags)
+                        closed[i] = count == 0
+                        pending[i] += count
+                    except BlockingIOError:
+                        pass
+                if destination in outputs_ready and pending[i] > 0:
+                    try:
+                        count = os.splice(pipe_read, destination.fileno(), pending[i], flags=flags)
+                        pending[i] -= count
+                        metrics.add_bytes(("up", "down")[i], count)
+                    except BlockingIOError:
+                        pass
+    except OSError as e:
+        log.warning("Relay failed: %s", e)
+    finally:
+        for direction in directions:
+            os.close(direction[2])
+            os.close(direction[3])
 
 
 class ClientThread(threading.Thread):
 
-    def __init__(self, client_socket, target_host, target_port):
+    def __init__(self, client_socket, target_host, target_port, intercept=True):
         threading.Thread.__init__(self)
         self.__client_socket = client_socket
         self.__target_host = target_host
         self.__target_port = target_port
+        self.__intercept = intercept
 
     def run(self):
-        print("Client thread started")
+        log.info("Client connection accepted")
 
         self.__client_socket.setblocking(0)
 
-        print("Connecting to target host")
+        log.debug("Connecting to %s:%d", self.__target_host, self.__target_port)
         target_host_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         target_host_socket.connect((self.__target_host, self.__target_port))
         target_host_socket.setblocking(0)
 
-        print("Ready for traffic - Packets max 100k, v = ES -> PSORT (down), ^ = PSORT -> ES (up)")
-        client_data = bytearray()
-        target_host_data = bytearray()
+        client_data = RelayBuffer(budget=memory_budget)
+        target_host_data = RelayBuffer(budget=memory_budget)
+        injected_data = RelayBuffer(budget=memory_budget)
+        response_data = RelayBuffer(budget=memory_budget)
+        up_watermark = Watermark()
+        down_watermark = Watermark()
         terminate_connection = False
-        found_index_creation=False
+        spliced = [0, 0] # bytes in the splice pipes, up and down
+        connection_id = metrics.open_connection(lambda: (len(target_host_data) + len(injected_data) + spliced[0],
+                                                         len(client_data) + spliced[1]))
+
+        # Both directions are framed until the mapping is in place: requests from psort as they
+        # arrive, responses from ES to pair them with the requests in order. Once the index creation
+        # is sent, psort's further requests are held until ES answered the injected _mapping PUT,
+        # whose response is dropped instead of forwarded.
+        request_framer = HttpRequestFramer() if self.__intercept else None
+        response_framer = HttpResponseFramer() if self.__intercept else None
+        response_actions = collections.deque() # "forward", "index_creation" or "mapping", in request order
+        upstream_sent = 0
+        index_creation = None
+        hold_upstream = False
 
         while not terminate_connection and not signal_term_proxy:
 
-            inputs = [self.__client_socket, target_host_socket]
+            # Nothing left to look at or to send from here: the kernel takes over
+            if (relay_splice and request_framer is None and response_framer is None and len(client_data) == 0
+                    and len(target_host_data) == 0 and len(injected_data) == 0 and len(response_data) == 0):
+                log.debug("Relaying with splice()")
+                splice_relay(self.__client_socket, target_host_socket, spliced)
+                break
+
+            inputs = []
             outputs = []
 
+            if not memory_budget.exhausted():
+                if not up_watermark.check(len(target_host_data) + len(injected_data)):
+                    inputs.append(self.__client_socket)
+                if not down_watermark.check(len(client_data)):
+                    inputs.append(target_host_socket)
+
             if len(client_data) > 0:
                 outputs.append(self.__client_socket)
 
-            if len(target_host_data) > 0:
+            if len(injected_data) > 0 or (len(target_host_data) > 0 and not hold_upstream):
                 outputs.append(target_host_socket)
 
+            if not inputs and not outputs:
+                time.sleep(0.01) # paused and nothing to send, wait for the other connections to drain
+                continue
+
             try:
-                inputs_ready, outputs_ready, errors_ready = select.select(inputs, outputs, [], 1.0)
+                inputs_ready, outputs_ready, errors_ready = select.select(inputs, outputs, [], 1.0 if len(inputs) == 2 else 0.05)
             except Exception as e:
-                print(e)
+                log.warning("Relay failed: %s", e)
                 break
 
             for inp in inputs_ready:
                 if inp == self.__client_socket:
                     try:
-                        data = self.__client_socket.recv(102400)
-                    except Exception as e:
-                        print(e)
-                    if data != None:
-                        if len(data) > 0:
-                            target_host_data += data
-                        else:
+                        if target_host_data.recv_from(self.__client_socket) == 0:
                             terminate_connection = True
+                        elif request_framer is not None and index_creation is None:
+                            for request in request_framer.feed(target_host_data.last_chunk()):
+                                response_framer.expect(request.method)
+                                if index_creation_target(request) is not None:
+                                    index_creation = request
+                                    response_actions.append("index_creation")
+                                    break
+                                response_actions.append("forward")
+                    except HttpFramingError as e:
+                        log.warning("Cannot frame requests, relaying as is: %s", e)
+                        request_framer = response_framer = index_creation = None
+                        hold_upstream = False
+                    except Exception as e:
+                        log.warning("Relay failed: %s", e)
 
                 elif inp == target_host_socket:
                     try:
-                        data = target_host_socket.recv(102400)
-                    except Exception as e:
-                        print(e)
-
-                    if data != None:
-                        if len(data) > 0:
-                            client_data += data
-                        else:
+                        if response_framer is None:
+                            if client_data.recv_from(target_host_socket) == 0:
+                                terminate_connection = True
+                        elif response_data.recv_from(target_host_socket) == 0:
                             terminate_connection = True
+                        else:
+                            responses = response_framer.feed(response_data.last_chunk())
+                            response_data.consume(len(response_data))
+                            for response in responses:
+                                action = response_actions.popleft() if response.status >= 200 else "forward"
+                                if action == "mapping":
+                                    report_mapping_response(index_creation_target(index_creation), response)
+                                elif action == "index_creation" and 200 <= response.status < 300:
+                                    if log.isEnabledFor(logging.DEBUG):
+                                        log.debug("Intercepted reply: %s", response.describe())
+                                    index_name = index_creation_target(index_creation)
+                                    log.info("Adding mapping for %s", index_name)
+                                    response_framer.expect("PUT")
+                                    response_actions.append("mapping")
+                                    mapping = mapping_request(index_name)
+                                    injected_data.append(mapping.head + mapping.body)
+                                elif action == "index_creation":
+                                    log.error("Index creation failed, no mapping added: %s", response.describe())
+
+                                if action != "mapping":
+                                    client_data.append(response.head)
+                                    client_data.append(response.body)
+                                if action == "mapping" or (action == "index_creation" and len(injected_data) == 0):
+                                    log.debug("Leaving interception")
+                                    request_framer = response_framer = index_creation = None
+                                    hold_upstream = False
+                    except HttpFramingError as e:
+                        log.warning("Cannot frame responses, relaying as is: %s", e)
+                        request_framer = response_framer = index_creation = None
+                        hold_upstream = False
+                    except Exception as e:
+                        log.warning("Relay failed: %s", e)
 
             for out in outputs_ready:
                 if out == self.__client_socket and len(client_data) > 0:
-                    sys.stdout.write('v')
-                    sys.stdout.flush()
-                    bytes_written = self.__client_socket.send(client_data)
-                    if bytes_written > 0:
-                        client_data = client_data[bytes_written:]
-
-                elif out == target_host_socket and len(target_host_data) > 0:
-
-                    sys.stdout.write('^')
-                    sys.stdout.flush()
-                    bytes_written = target_host_socket.send(target_host_data)
+                    metrics.add_bytes("down", client_data.send_to(self.__client_socket))
 
-                    temp_target_host_data=target_host_data
+                elif out == target_host_socket and len(injected_data) > 0:
+                    injected_data.send_to(target_host_socket)
 
-                    if bytes_written > 0:
-                        target_host_data = target_host_data[bytes_written:]
+                elif out == target_host_socket and len(target_host_data) > 0 and not hold_upstream:
+                    if index_creation is not None:
+                        bytes_written = target_host_data.send_to(target_host_socket, index_creation.end_offset - upstream_sent)
+                    else:
+                        bytes_written = target_host_data.send_to(target_host_socket)
+                    upstream_sent += bytes_written
+                    metrics.add_bytes("up", bytes_written)
 
                     # Logic to intercept the index creation request in order to
                     # sneak in additional requests to define mapping et al.
-                    if not found_index_creation:
-                        string_data=temp_target_host_data.decode('utf-8')
-
-                        if "PUT /" in string_data and "mappings" in string_data:
-                            print("\n\nINTERCEPT TO ADD MAPPING");
-                            found_index_creation = True
-                            start = string_data.index("PUT /") + len("PUT /")
-                            end = string_data.index(" HTTP/", start)
-                            index_name=string_data[start:end] # no error handling, it's a hack after all :)
-                            print("TO ES: ",string_data,"\n\n")
-
-                            target_host_socket.setblocking(1) # we want to wait for the replay right now
-                            d = target_host_socket.recv(10240)
-                            print("INTERCEPTED REPLAY:", d)
-                            msg = "PUT /" + index_name + "/_mapping/"+document_name + ' HTTP/1.1\r\nHost: 127.0.0.1:'+str(proxy_listening_port)+'\r\nAccept-Encoding: identity\r\nContent-Length: ' + \
-                                  str(len(putmappingbody)) + '\r\nconnection: keep-alive\r\ncontent-type: application/json\r\n\r\n' + putmappingbody
-                            print("ADD MAPPING for " + index_name)
-                            target_host_socket.setblocking(0)
-                            target_host_socket.send(msg.encode())
-                            print("LEAVE INTERCEPTION\n\n")
+                    if index_creation is not None and upstream_sent == index_creation.end_offset:
+                        log.info("Intercepting creation of index %s to add the mapping", index_creation_target(index_creation))
+                        if log.isEnabledFor(logging.DEBUG):
+                            log.debug("To ES: %s", index_creation.describe())
+                        hold_upstream = True
 
+        metrics.close_connection(connection_id)
+        for data in (client_data, target_host_data, injected_data, response_data):
+            data.consume(len(data))
         self.__client_socket.close()
         target_host_socket.close()
-        print("\nClient connection/thread terminated. CTRL+C to stop proxy to listen for new connections.")
+        log.info("Client connection terminated")
 
 
-if __name__ == '__main__':
+# Segmented journal of --journal (see journal_directory). A record is the request target and body
+# behind a header with a magic, the lengths and a CRC32; the header is written last, and records
+# of a segment end at the first header that does not check out. The writer appends through a
+# shared memory map, the drainer reads the segments back with pread().
+class BulkJournal:
+
+    __HEADER = struct.Struct("<4sIIH") # magic, body length, CRC32 of target + body, target length
+    __MAGIC = b"PSJ1"
+
+    def __init__(self, directory):
+        self.__directory = directory
+        self.__ends = {} # segment -> end of its records
+        self.__readers = {} # segment -> file descriptor of the drainer
+        self.__segment = 0
+        self.__file = None
+        self.__map = None
+        self.__lock = asyncio.Lock()
+        self.__appends = 0
+        self.__synced = 0
+        self.__sync_task = None
+        self.__appended = asyncio.Event()
+        self.position = (0, 0) # (segment, offset) of the first record not drained yet
+
+    def open(self):
+        os.makedirs(self.__directory, exist_ok=True)
+        segments = sorted(int(name[:-8]) for name in os.listdir(self.__directory)
+                          if name.endswith(".journal") and name[:-8].isdigit())
+        for segment in segments:
+            self.__ends[segment] = self.__scan(segment)
+        try:
+            with open(os.path.join(self.__directory, "checkpoint")) as checkpoint:
+                segment, offset = checkpoint.read().split()
+                self.position = (int(segment), int(offset))
+        except (OSError, ValueError):
+            self.position = (segments[0], 0) if segments else (0, 0)
+
+        self.__segment = max(segments) if segments else self.position[0]
+        self.__open_segment(self.__segment, journal_segment_size)
+        self.__remove_drained()
+        if self.backlog() > 0:
+            log.info("Journal %s: %.1f MB to drain from segment %d", self.__directory, self.backlog() / 1048576, self.position[0])
+
+    def close(self):
+        if self.__map is not None:
+            self.__map.flush()
+            self.__map.close()
+            self.__file.close()
+        for fd in self.__readers.values():
+            os.close(fd)
+        self.__readers.clear()
+
+    def backlog(self):
+        segment, offset = self.position
+        return sum(end for other, end in self.__ends.items() if other > segment) + max(self.__ends.get(segment, 0) - offset, 0)
+
+    # Appends a request, returns once it is durable
+    async def append(self, target, body):
+        target = target.encode("latin-1")
+        size = self.__HEADER.size + len(target) + len(body)
+        async with self.__lock:
+            if self.__ends[self.__segment] + size > len(self.__map):
+                await self.__rotate(size)
+            offset = self.__ends[self.__segment]
+            start = offset + self.__HEADER.size
+            self.__map[start:start + len(target)] = target
+            self.__map[start + len(target):offset + size] = body
+            self.__map[offset:start] = self.__HEADER.pack(self.__MAGIC, len(body), zlib.crc32(body, zlib.crc32(target)), len(target))
+            self.__ends[self.__segment] = offset + size
+            self.__appends += 1
+            self.__appended.set()
+
+        if journal_fsync:
+            appends = self.__appends
+            while self.__synced < appends:
+                if self.__sync_task is None:
+                    self.__sync_task = asyncio.ensure_future(self.__sync())
+                await asyncio.shield(self.__sync_task)
+
+    # Group commit: one msync() covers all appends made before it starts
+    async def __sync(self):
+        try:
+            appends = self.__appends
+            await asyncio.get_running_loop().run_in_executor(None, self.__map.flush)
+            self.__synced = max(self.__synced, appends)
+        finally:
+            self.__sync_task = None
+
+    async def __rotate(self, size):
+        while self.__sync_task is not None:
+            await asyncio.shield(self.__sync_task)
+        # No await from here on, so no msync() of the old segment can start while it is closed
+        self.__map.flush()
+        self.__synced = self.__appends
+        self.__map.close()
+        self.__file.close()
+        self.__segment += 1
+        self.__open_segment(self.__segment, max(journal_segment_size, size))
+
+    def __path(self, segment):
+        return os.path.join(self.__directory, "%010d.journal" % segment)
+
+    def __open_segment(self, segment, size):
+        path = self.__path(segment)
+        self.__file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        if os.fstat(self.__file.fileno()).st_size < size:
+            self.__file.truncate(size)
+        self.__map = mmap.mmap(self.__file.fileno(), 0)
+        end = self.__ends.setdefault(segment, 0)
+        if any(self.__map[end:end + self.__HEADER.size]):
+            self.__map[end:] = bytes(len(self.__map) - end) # torn write of a crash, no record may follow it
+
+    # End of the intact records of a segment
+    def __scan(self, segment):
+        with open(self.__path(segment), "rb") as segment_file:
+            data = segment_file.read()
+        offset = 0
+        while offset + self.__HEADER.size <= len(data):
+            magic, length, crc, target_length = self.__HEADER.unpack_from(data, offset)
+            start = offset + self.__HEADER.size
+            end = start + target_length + length
+            if magic != self.__MAGIC or end > len(data) or zlib.crc32(data[start:end]) != crc:
+                break
+            offset = end
+        return offset
+
+    # Wakes up once a record was appended after the last read()
+    async def wait(self):
+        await self.__appended.wait()
+
+    # Records from the position on that share the first one's target, up to max_bytes of bodies
+    # (at least one record). Returns the target, the bodies and the position after them.
+    def read(self, max_bytes):
+        self.__appended.clear()
+        segment, offset = self.position
+        target = None
+        bodies = []
+        size = 0
+        while True:
+            if offset >= self.__ends.get(segment, 0):
+                if segment >= self.__segment:
+                    break
+                segment, offset = segment + 1, 0
+                continue
+
+            fd = self.__readers.get(segment)
+            if fd is None:
+                fd = self.__readers[segment] = os.open(self.__path(segment), os.O_RDONLY)
+            magic, length, crc, target_length = self.__HEADER.unpack(os.pread(fd, self.__HEADER.size, offset))
+            if target is not None and size + length > max_bytes:
+                break
+            data = os.pread(fd, target_length + length, offset + self.__HEADER.size)
+            if zlib.crc32(data) != crc:
+                log.error("Journal segment %d is corrupt at %d, skipping its remaining %d bytes", segment, offset, self.__ends[segment] - offset)
+                offset = self.__ends[segment]
+                continue
+            record_target = data[:target_length].decode("latin-1")
+            if target is not None and record_target != target:
+                break
+            target = record_target
+            bodies.append(data[target_length:])
+            size += length
+            offset += self.__HEADER.size + target_length + length
+        return target, bodies, (segment, offset)
+
+    # Records everything before the position as drained, removing the segments left behind
+    def commit(self, position):
+        self.position = position
+        checkpoint_path = os.path.join(self.__directory, "checkpoint")
+        with open(checkpoint_path + ".tmp", "w") as checkpoint:
+            checkpoint.write("%d %d\n" % position)
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+        self.__remove_drained()
+
+    def __remove_drained(self):
+        for segment in [segment for segment in self.__ends if segment < min(self.position[0], self.__segment)]:
+            fd = self.__readers.pop(segment, None)
+            if fd is not None:
+                os.close(fd)
+            os.remove(self.__path(segment))
+            del self.__ends[segment]
+
+
+# Sends the journaled requests to ES, retrying with growing delays while ES is down or overloaded.
+# A batch ES refuses as a whole (4xx) is logged and skipped, so it cannot block the journal.
+class JournalDrainer:
+
+    def __init__(self, journal, upstream):
+        self.__journal = journal
+        self.__upstream = upstream
+        self.__task = None
+
+    def start(self):
+        self.__task = asyncio.ensure_future(self.__run())
+
+    def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+
+    async def __run(self):
+        delay = 1.0
+        while True:
+            target, bodies, position = self.__journal.read(bulk_batch_bytes)
+            if not bodies:
+                await self.__journal.wait()
+                continue
+
+            request = HttpRequest("POST", target, "HTTP/1.1", [("Host", "%s:%d" % (target_elastic_host, target_elastic_port)),
+                                                                ("Content-Type", "application/x-ndjson")])
+            request.set_body(b"".join(bodies))
+            try:
+                response = await exchange_bulk(self.__upstream, request)
+                error = None if response.status != 429 and response.status < 500 else response.describe()
+            except (OSError, HttpFramingError) as e:
+                error = e
+            if error is not None:
+                log.warning("Journal drain failed, retrying in %.0f s: %s", delay, error)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, journal_retry_max_delay)
+                continue
+
+            delay = 1.0
+            report_bulk_response("Journal batch", response)
+            self.__journal.commit(position)
+
+
+# asyncio engine: one event loop serves all client connections. Requests from psort are framed,
+# passed through the pipeline stages (coercion, re-batching, index creation interception) and
+# exchanged with ES through the upstream pool, one at a time and in order.
+class AsyncProxyConnection:
+
+    def __init__(self, client_reader, client_writer, upstream, batcher=None, intercept=True, journal=None, profile=None,
+                 router=None):
+        self.__client_reader = client_reader
+        self.__client_writer = client_writer
+        self.__upstream = upstream
+        self.__batcher = batcher
+        self.__journal = journal
+        self.__profile = profile
+        self.__router = router
+        self.__found_index_creation = not intercept
+        self.__task = None
+        self.__framer = None
+        self.__upstream_writer = None
+        self.__buffered = 0
+        self.__rewriters = set() # BulkRewriters of this connection's requests not yet handled
+
+    async def run(self):
+        log.info("Client connection accepted")
+        self.__task = asyncio.current_task()
+        connection_id = metrics.open_connection(self.__buffer_depths)
+
+        self.__client_writer.transport.set_write_buffer_limits(buffer_high_watermark, buffer_low_watermark)
+
+        try:
+            if self.__found_index_creation and not http_stages_enabled():
+                await self.__relay()
+            else:
+                await self.__serve()
+        finally:
+            for rewriter in list(self.__rewriters):
+                self.__release(rewriter) # requests psort did not finish sending, or never answered
+            self.__account(0)
+            if self.__profile is not None:
+                self.__profile.detach(self)
+            metrics.close_connection(connection_id)
+            await self.__close_client()
+            log.info("Client connection terminated")
+
+    def close(self):
+        if self.__task is not None:
+            self.__task.cancel()
+
+    # Bytes of the request being read and of the data not yet taken by the sockets
+    def __buffer_depths(self):
+        up = self.__framer.pending() if self.__framer is not None else 0
+        if self.__upstream_writer is not None and self.__upstream_writer.transport is not None:
+            up += self.__upstream_writer.transport.get_write_buffer_size()
+        down = self.__client_writer.transport.get_write_buffer_size() if self.__client_writer.transport is not None else 0
+        return up, down
+
+    async def __close_client(self):
+        self.__client_writer.close()
+        try:
+            await self.__client_writer.wait_closed()
+        except OSError:
+            pass
+
+    # Passthrough: the index template takes care of the mapping and no stage needs the requests
+    async def __relay(self):
+        try:
+            upstream_reader, upstream_writer = await self.__upstream.open_stream()
+        except OSError as e:
+            log.error("Cannot connect to Elasticsearch: %s", e)
+            return
+        self.__upstream_writer = upstream_writer
+        upstream_writer.transport.set_write_buffer_limits(buffer_high_watermark, buffer_low_watermark)
+
+        pumps = [asyncio.ensure_future(_pump(self.__client_reader, upstream_writer, "up")),
+                 asyncio.ensure_future(_pump(upstream_reader, self.__client_writer, "down"))]
+        try:
+            await asyncio.wait(pumps, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for pump in pumps:
+                pump.cancel()
+            upstream_writer.close()
+
+    # Keeps the global budget up to date with the bytes of the requests this connection holds
+    def __account(self, buffered):
+        if buffered > self.__buffered:
+            memory_budget.add(buffered - self.__buffered)
+        elif buffered < self.__buffered:
+            memory_budget.release(self.__buffered - buffered)
+        self.__buffered = buffered
+
+    async def __serve(self):
+        framer = self.__framer = HttpRequestFramer(self.__body_filter)
+
+        while True:
+            if framer.pending() == 0 and memory_budget.exhausted():
+                await memory_budget.wait_available()
+            try:
+                data = await self.__client_reader.read(102400)
+            except OSError as e:
+                log.warning("Client read failed: %s", e)
+                return
+            if len(data) == 0:
+                return
+
+            try:
+                requests = framer.feed(data)
+            except HttpFramingError as e:
+                log.warning("Cannot frame request, closing connection: %s", e)
+                return
+            unhandled = sum(len(request.body) for request in requests)
+            self.__account(framer.pending() + unhandled)
+
+            for request in requests:
+                unhandled -= len(request.body)
+                endpoint = request_endpoint(request)
+                metrics.add_message("up", endpoint, len(request.head) + len(request.body))
+                start = time.monotonic()
+                try:
+                    response = await self.__handle(request)
+                finally:
+                    if isinstance(request.body_filter, BulkRewriter):
+                        self.__release(request.body_filter)
+                if isinstance(request.body_filter, BulkRewriter) and request.body_filter.dropped:
+                    response = restore_dropped_items(response, request.body_filter)
+                metrics.observe_latency(endpoint, time.monotonic() - start)
+
+                self.__account(framer.pending() + unhandled)
+
+                metrics.add_message("down", endpoint, len(response.head) + len(response.body))
+                self.__client_writer.writelines((response.head, response.body))
+                await self.__client_writer.drain()
+                if not request.keep_alive() or not response.keep_alive():
+                    return
+
+    def __body_filter(self, request):
+        if ((bulk_coerce_values or self.__router is not None or document_ids is not None or deduplicator is not None)
+                and is_bulk_request(request) and request.header("Content-Encoding") is None):
+            rewriter = BulkRewriter(field_type_cache.field_types if bulk_coerce_values else None,
+                                    request.path[:-len("_bulk")].strip("/") or None, self.__router, deduplicator)
+            self.__rewriters.add(rewriter)
+            return rewriter
+        return None
+
+    # Lets go of the dedupe fingerprints a rewriter made pending, unless its documents were handed
+    # over to ES (see __handed_over), where exchange_bulk() settles them
+    def __release(self, rewriter):
+        self.__rewriters.discard(rewriter)
+        if rewriter.pending:
+            deduplicator.release(rewriter.pending)
+            rewriter.pending = []
+
+    @staticmethod
+    def __handed_over(request):
+        if isinstance(request.body_filter, BulkRewriter):
+            request.body_filter.pending = []
+
+    async def __handle(self, request):
+        if isinstance(request.body_filter, BulkRewriter) and request.body_filter.coerced_values > 0:
+            metrics.add_coerced_values(request.body_filter.coerced_values)
+            log.debug("Coerced %d values in %d documents", request.body_filter.coerced_values, request.body_filter.documents)
+
+        try:
+            if self.__router is not None and index_creation_target(request) is not None:
+                self.__found_index_creation = True
+                return self.__router.creation_response(index_creation_target(request))
+            if not self.__found_index_creation:
+                index_name = index_creation_target(request)
+                if index_name is not None:
+                    self.__found_index_creation = True
+                    return await self.__intercept_index_creation(request, index_name)
+
+            if isinstance(request.body_filter, BulkRewriter) and request.body_filter.dropped and len(request.body) == 0:
+                return json_response(200, {"took": 0, "errors": False, "items": []}) # all duplicates
 
+            routed = request.body_filter.indices if isinstance(request.body_filter, BulkRewriter) else {}
+            if routed:
+                await self.__router.ensure(routed)
+            if self.__profile is not None and is_bulk_request(request):
+                for index_name in routed or [bulk_request_index(request)]:
+                    if index_name is not None:
+                        await self.__profile.attach(index_name, self)
+
+            if self.__journal is not None and is_bulk_request(request):
+                body = request.decoded_body()
+                await self.__journal.append(request.target, body)
+                self.__handed_over(request)
+                return queued_bulk_response(request, split_bulk_items(body))
+
+            if self.__batcher is not None:
+                if is_bulk_request(request) and request.header("Content-Encoding") is None:
+                    response = await self.__batcher.submit(request)
+                    self.__handed_over(request)
+                    return response
+                await self.__batcher.flush() # psort reads what it wrote
+
+            if not is_bulk_request(request):
+                return await self.__upstream.exchange(request)
+            response = await exchange_bulk_fanout(self.__upstream, request)
+            self.__handed_over(request)
+            if metrics_port is not None:
+                observe_bulk_response(response)
+            return response
+        except (OSError, HttpFramingError) as e:
+            log.warning("ES exchange failed: %s", e)
+            return error_response(502, "proxy_exception", "Elasticsearch exchange failed: %s" % e)
+
+    # Logic to intercept the index creation request in order to
+    # sneak in additional requests to define mapping et al.
+    async def __intercept_index_creation(self, request, index_name):
+        log.info("Intercepting creation of index %s to add the mapping", index_name)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("To ES: %s", request.describe())
+
+        # Only this connection waits, the event loop keeps serving the others. psort's next
+        # request is not read before the mapping is in place.
+        response = await self.__upstream.exchange(request)
+        if 200 <= response.status < 300:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Intercepted reply: %s", response.describe())
+            log.info("Adding mapping for %s", index_name)
+            try:
+                report_mapping_response(index_name, await self.__upstream.exchange(mapping_request(index_name)))
+            except (OSError, HttpFramingError) as e:
+                log.error("Mapping failed for %s: %s", index_name, e)
+            if self.__profile is not None:
+                await self.__profile.attach(index_name, self)
+        else:
+            log.error("Index creation failed, no mapping added: %s", response.describe())
+        log.debug("Leaving interception")
+        return response
+
+
+async def _pump(reader, writer, direction):
+    try:
+        while True:
+            data = await reader.read(relay_recv_size)
+            if len(data) == 0:
+                return
+            metrics.add_bytes(direction, len(data))
+            writer.write(data)
+            await writer.drain()
+    except OSError as e:
+        log.warning("Relay failed: %s", e)
+
+
+def open_listening_socket():
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if proxy_workers > 1:
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     server_socket.bind((proxy_listening_host, proxy_listening_port))
-    server_socket.listen(5)
-    print("Waiting for connections...")
+    return server_socket
+
+
+async def serve_async_proxy():
+    global deduplicator
+    connections = set()
+    nodes = [(node.rpartition(":")[0], int(node.rpartition(":")[2])) for node in target_elastic_nodes]
+    upstream = UpstreamPool(nodes or [(target_elastic_host, target_elastic_port)])
+    await upstream.start()
+    if mapping_cache_file is not None:
+        field_type_cache.load(mapping_cache_file)
+    batcher = BulkBatcher(upstream) if bulk_rebatch and journal_directory is None else None
+    profile = None
+    if bulk_profile:
+        profile = BulkLoadProfile(upstream)
+        profile.start()
+    router = IndexRouter(upstream) if index_routing_time is not None or index_routing_field is not None else None
+    if dedupe:
+        deduplicator = Deduplicator()
+        if dedupe_file is not None:
+            deduplicator.load(dedupe_file)
+        metrics.track_dedupe(deduplicator.stats)
+    journal = None
+    drainer = None
+    if journal_directory is not None:
+        journal = BulkJournal(journal_directory if worker_index is None else os.path.join(journal_directory, "worker-%d" % worker_index))
+        journal.open()
+        metrics.track_journal(journal.backlog)
+        drainer = JournalDrainer(journal, upstream)
+        drainer.start()
+    metrics_server = start_metrics_server(metrics.snapshot) if metrics_port is not None and worker_index is None else None
+    template = None
+    template_task = None
+    if index_template is not None:
+        template = IndexTemplate(upstream)
+        await template.verify()
+        if http_stages_enabled():
+            log.warning("Index template mode still reads every request for %s, connections are not relayed byte for byte",
+                        ", ".join(http_stages()))
+        template_task = asyncio.ensure_future(template.maintain())
+
+    async def handle_client(client_reader, client_writer):
+        intercept = template is None or not template.installed
+        connection = AsyncProxyConnection(client_reader, client_writer, upstream, batcher, intercept, journal, profile, router)
+        connections.add(connection)
+        try:
+            await connection.run()
+        except asyncio.CancelledError:
+            pass # proxy shutdown
+        finally:
+            connections.discard(connection)
+
+    server = await asyncio.start_server(handle_client, sock=open_listening_socket(), backlog=proxy_listen_backlog)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM) if worker_index is None else (signal.SIGTERM,):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except (NotImplementedError, AttributeError, ValueError):
+            pass # Windows: CTRL+C surfaces as KeyboardInterrupt in asyncio.run()
+
+    log.info("Waiting for connections on %s:%d", proxy_listening_host, proxy_listening_port)
+    try:
+        await stop.wait()
+    finally:
+        log.info("Gracefully terminating proxy...")
+        server.close()
+        await server.wait_closed()
+        for connection in list(connections):
+            connection.close()
+        while connections:
+            await asyncio.sleep(0.05)
+        if batcher is not None:
+            await batcher.flush()
+            batcher.close()
+        if journal is not None:
+            drainer.close()
+            if journal.backlog() > 0:
+                log.info("%.1f MB left in the journal, drained at the next start", journal.backlog() / 1048576)
+            journal.close()
+        if profile is not None:
+            await profile.close()
+        if deduplicator is not None:
+            deduplicator.report()
+            if dedupe_file is not None:
+                deduplicator.save(dedupe_file)
+        if template_task is not None:
+            template_task.cancel()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        upstream.close()
+
+
+def run_thread_proxy():
+    global signal_term_proxy
+
+    server_socket = open_listening_socket()
+    server_socket.listen(proxy_listen_backlog)
+    if metrics_port is not None and worker_index is None:
+        start_metrics_server(metrics.snapshot)
+
+    # The template is kept up to date by its own event loop thread
+    template = None
+    if index_template is not None:
+        template = IndexTemplate(UpstreamConnection(target_elastic_host, target_elastic_port))
+        verified = threading.Event()
+
+        async def maintain_template():
+            await template.verify()
+            verified.set()
+            await template.maintain()
+
+        threading.Thread(target=asyncio.run, args=(maintain_template(),), daemon=True).start()
+        verified.wait(upstream_health_interval)
+
+    log.info("Waiting for connections on %s:%d", proxy_listening_host, proxy_listening_port)
 
     while True:
 
         try:
             accepted_socket, address = server_socket.accept()
         except KeyboardInterrupt:
-            print("\nGracefully terminating proxy...")
+            log.info("Gracefully terminating proxy...")
             signal_term_proxy = True
             break
 
-        ClientThread(accepted_socket, target_elastic_host, target_elastic_port).start()
+        intercept = template is None or not template.installed
+        ClientThread(accepted_socket, target_elastic_host, target_elastic_port, intercept).start()
 
     server_socket.close()
-    print("\nProxy terminated. Over and Out!");
 
+
+def run_engine():
+    if proxy_engine == "thread":
+        run_thread_proxy()
+    else:
+        try:
+            asyncio.run(serve_async_proxy())
+        except KeyboardInterrupt:
+            pass
+
+
+# Sends the metrics of a worker process to the supervisor, one JSON line per interval
+class StatsReporter(threading.Thread):
+
+    def __init__(self, stats_fd):
+        threading.Thread.__init__(self, daemon=True)
+        self.__stats_fd = stats_fd
+        self.__stop = threading.Event()
+
+    def stop(self):
+        self.__stop.set()
+        self.join()
+
+    def run(self):
+        while True:
+            stopped = self.__stop.wait(log_progress_interval)
+            data = json.dumps(metrics.snapshot()).encode() + b"\n"
+            try:
+                while data:
+                    data = data[os.write(self.__stats_fd, data):]
+            except OSError:
+                return
+            if stopped:
+                return
+
+
+# Body of a forked worker process: the configured engine on the shared port
+def run_worker(index, stats_fd):
+    global worker_index
+    worker_index = index
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # CTRL+C reaches the supervisor, which stops the workers
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    stop_logging = setup_logging(None, "worker %d: " % index)
+    reporter = StatsReporter(stats_fd)
+    reporter.start()
+
+    status = 0
+    try:
+        run_engine()
+    except Exception:
+        log.exception("Worker %d failed", index)
+        status = 1
+    reporter.stop()
+    stop_logging()
+    return status
+
+
+# Forks the workers of --workers, restarts them when they die and stops them on CTRL+C or
+# SIGTERM. Their metrics come in through a pipe per worker; those of restarted workers are kept,
+# so the counters of snapshot() never go back.
+class WorkerSupervisor:
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__workers = {} # pid -> (index, stats pipe, start time)
+        self.__lines = {} # stats pipe -> bytes of an incomplete line
+        self.__snapshots = {} # index -> last metrics of the worker
+        self.__retired = {} # metrics of the workers that died
+        self.__stopping = False
+
+    def snapshot(self):
+        with self.__lock:
+            snapshots = [self.__retired]
+            for index, snapshot in self.__snapshots.items():
+                snapshot = dict(snapshot)
+                snapshot["connections"] = dict(("%d/%s" % (index, connection_id), depths)
+                                               for connection_id, depths in snapshot.get("connections", {}).items())
+                snapshots.append(snapshot)
+            return merge_metrics(snapshots)
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.__stop)
+        signal.signal(signal.SIGTERM, self.__stop)
+        for index in range(proxy_workers):
+            self.__start_worker(index)
+
+        while self.__workers:
+            readable, writable, errors = select.select([worker[1] for worker in self.__workers.values()], [], [], 0.5)
+            for stats_fd in readable:
+                self.__read_stats(stats_fd)
+            self.__reap()
+
+    def __stop(self, signum, frame):
+        if not self.__stopping:
+            self.__stopping = True
+            log.info("Gracefully terminating workers...")
+            for pid in self.__workers:
+                os.kill(pid, signal.SIGTERM)
+
+    def __start_worker(self, index):
+        stats_read_fd, stats_write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(stats_read_fd)
+            for worker in self.__workers.values():
+                os.close(worker[1])
+            os._exit(run_worker(index, stats_write_fd))
+
+        os.close(stats_write_fd)
+        self.__workers[pid] = (index, stats_read_fd, time.monotonic())
+        self.__lines[stats_read_fd] = b""
+        log.info("Worker %d started, pid %d", index, pid)
+
+    def __read_stats(self, stats_fd):
+        try:
+            data = os.read(stats_fd, 1024 * 1024)
+        except OSError:
+            data = b""
+        lines = (self.__lines[stats_fd] + data).split(b"\n")
+        self.__lines[stats_fd] = lines.pop()
+        index = next(worker[0] for worker in self.__workers.values() if worker[1] == stats_fd)
+        for line in lines:
+            with self.__lock:
+                self.__snapshots[index] = json.loads(line)
+
+    def __reap(self):
+        while self.__workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            index, stats_fd, start_time = self.__workers.pop(pid)
+            self.__read_stats_until_eof(stats_fd, index)
+            with self.__lock:
+                snapshot = self.__snapshots.pop(index, {})
+                snapshot.pop("connections", None)
+                self.__retired = merge_metrics([self.__retired, snapshot])
+
+            if self.__stopping:
+                log.info("Worker %d stopped", index)
+                continue
+            log.warning("Worker %d (pid %d) exited with status %d, restarting", index, pid, os.waitstatus_to_exitcode(status))
+            if time.monotonic() - start_time < 1.0:
+                time.sleep(1.0) # no busy loop if it dies at startup
+            self.__start_worker(index)
+
+    def __read_stats_until_eof(self, stats_fd, index):
+        data = self.__lines.pop(stats_fd)
+        while True:
+            chunk = os.read(stats_fd, 1024 * 1024)
+            if not chunk:
+                break
+            data += chunk
+        os.close(stats_fd)
+        for line in data.split(b"\n"):
+            if line:
+                with self.__lock:
+                    self.__snapshots[index] = json.loads(line)
+
+
+def parse_command_line():
+    global proxy_engine, proxy_listening_host, proxy_listening_port, target_elastic_host, target_elastic_port
+    global target_elastic_nodes, upstream_pool_size, upstream_compression, upstream_compression_level
+    global bulk_coerce_values, bulk_rebatch, bulk_batch_bytes, bulk_batch_documents, bulk_batch_linger
+    global journal_directory, journal_segment_size, journal_fsync
+    global bulk_retry_rejected, bulk_retry_attempts, mapping_learning, mapping_cache_file
+    global bulk_fanout, bulk_fanout_min_bytes, bulk_profile, bulk_profile_idle_time, bulk_profile_forcemerge
+    global index_template, index_template_name, index_template_pattern, index_template_verify_interval
+    global mapping_profile, mapping_alldata_fields, putmappingbody, index_routing_time, index_routing_field
+    global document_ids, document_id_fields, dedupe, dedupe_fields, dedupe_file, dedupe_max_bytes
+    global metrics_host, metrics_port, log_level, log_body_limit, proxy_workers, relay_splice
+    global buffer_high_watermark, buffer_low_watermark, global_buffer_high_watermark, global_buffer_low_watermark
+
+    parser = argparse.ArgumentParser(description="PLASO psort to ElasticSearch proxy.")
+    parser.add_argument("--engine", choices=("asyncio", "thread"), default=proxy_engine,
+                        help="relay engine (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=proxy_workers,
+                        help="worker processes sharing the listening port (default: %(default)s)")
+    parser.add_argument("--listen-host", default=proxy_listening_host)
+    parser.add_argument("--listen-port", type=int, default=proxy_listening_port)
+    parser.add_argument("--es-host", default=target_elastic_host)
+    parser.add_argument("--es-port", type=int, default=target_elastic_port)
+    parser.add_argument("--es-node", action="append", metavar="HOST:PORT",
+                        help="Elasticsearch node to spread the requests over (asyncio engine, repeatable)")
+    parser.add_argument("--pool-size", type=int, default=upstream_pool_size,
+                        help="keep-alive connections kept per node (default: %(default)s)")
+    parser.add_argument("--compress", choices=("gzip", "deflate"), default=upstream_compression,
+                        help="compress request bodies to ES and accept gzip responses (asyncio engine)")
+    parser.add_argument("--compression-level", type=int, choices=range(1, 10), default=upstream_compression_level,
+                        metavar="1-9", help="zlib level of --compress (default: %(default)s)")
+    parser.add_argument("--buffer-high", type=int, default=buffer_high_watermark,
+                        help="bytes a connection buffers per direction before it stops reading (default: %(default)s)")
+    parser.add_argument("--buffer-low", type=int, default=buffer_low_watermark,
+                        help="bytes at which a paused connection reads again (default: %(default)s)")
+    parser.add_argument("--global-buffer-high", type=int, default=global_buffer_high_watermark,
+                        help="bytes all connections buffer before they stop reading (default: %(default)s)")
+    parser.add_argument("--global-buffer-low", type=int, default=global_buffer_low_watermark,
+                        help="bytes at which the paused connections read again (default: %(default)s)")
+    parser.add_argument("--no-splice", action="store_true",
+                        help="relay uninspected thread engine connections in Python instead of with splice()")
+    parser.add_argument("--coerce", action="store_true", default=bulk_coerce_values,
+                        help="coerce the values of _bulk documents to the mapped types (asyncio engine, costs throughput)")
+    parser.add_argument("--mapping-profile", choices=("full", "lean"), default=mapping_profile,
+                        help="mapping given to the psort indices (default: %(default)s)")
+    parser.add_argument("--alldata-fields", nargs="+", metavar="FIELD", default=mapping_alldata_fields,
+                        help="fields the lean mapping profile copies to alldata (default: %(default)s)")
+    parser.add_argument("--no-learn", action="store_true",
+                        help="do not learn the types of fields ES rejects values of")
+    parser.add_argument("--mapping-cache", metavar="FILE", default=mapping_cache_file,
+                        help="keep the learned field types in FILE across runs")
+    parser.add_argument("--rebatch", action="store_true", default=bulk_rebatch,
+                        help="acknowledge small _bulk requests right away and send them to ES in size-targeted batches")
+    parser.add_argument("--batch-bytes", type=int, default=bulk_batch_bytes)
+    parser.add_argument("--batch-docs", type=int, default=bulk_batch_documents)
+    parser.add_argument("--batch-linger", type=float, default=bulk_batch_linger,
+                        help="seconds a batch waits for more documents (default: %(default)s)")
+    parser.add_argument("--route-time", choices=("day", "month", "year"), default=index_routing_time,
+                        help="send the events to an index per day, month or year of their datetime (asyncio engine)")
+    parser.add_argument("--route-by", metavar="FIELD", default=index_routing_field,
+                        help="send the events to an index per value of FIELD, e.g. data_type or parser (asyncio engine)")
+    parser.add_argument("--stable-ids", choices=("index", "create"), default=document_ids,
+                        help="give documents an _id hashed from --id-fields, so a rerun overwrites (index) or "
+                             "keeps (create) the documents of an earlier run (asyncio engine)")
+    parser.add_argument("--id-fields", nargs="+", metavar="FIELD", default=document_id_fields,
+                        help="fields the _id of --stable-ids is hashed from (default: %(default)s)")
+    parser.add_argument("--dedupe", action="store_true", default=dedupe,
+                        help="drop _bulk documents seen before (asyncio engine, not with --workers)")
+    parser.add_argument("--dedupe-fields", nargs="+", metavar="FIELD", default=dedupe_fields,
+                        help="fields the dedupe fingerprint is taken from (default: %(default)s)")
+    parser.add_argument("--dedupe-file", metavar="FILE", default=dedupe_file,
+                        help="load the dedupe filter from FILE at startup and save it there at shutdown")
+    parser.add_argument("--dedupe-max-mb", type=int, default=dedupe_max_bytes // 1048576,
+                        help="memory of the dedupe filter (default: %(default)s)")
+    parser.add_argument("--bulk-profile", action="store_true", default=bulk_profile,
+                        help="switch indices to bulk-load settings while psort writes to them (asyncio engine, not with --workers)")
+    parser.add_argument("--profile-idle-time", type=float, default=bulk_profile_idle_time,
+                        help="seconds without _bulk request after which an index gets its settings back (default: %(default)s)")
+    parser.add_argument("--forcemerge", type=int, metavar="SEGMENTS", default=bulk_profile_forcemerge,
+                        help="force merge an index to SEGMENTS segments after the bulk load")
+    parser.add_argument("--fanout", type=int, default=bulk_fanout,
+                        help="ES connections a large _bulk request is spread over (default: %(default)s)")
+    parser.add_argument("--fanout-min-bytes", type=int, default=bulk_fanout_min_bytes,
+                        help="smallest slice of a spread _bulk request (default: %(default)s)")
+    parser.add_argument("--retry-attempts", type=int, default=bulk_retry_attempts,
+                        help="rounds of retries of _bulk items ES rejects with 429 (default: %(default)s)")
+    parser.add_argument("--no-retry", action="store_true",
+                        help="pass _bulk items ES rejects with 429 on to psort without retrying them")
+    parser.add_argument("--journal", metavar="DIR", default=journal_directory,
+                        help="acknowledge _bulk requests once journaled in DIR and drain the journal into ES (asyncio engine)")
+    parser.add_argument("--journal-segment-size", type=int, default=journal_segment_size,
+                        help="bytes per journal segment file (default: %(default)s)")
+    parser.add_argument("--journal-no-fsync", action="store_true",
+                        help="acknowledge journaled requests without waiting for the disk")
+    parser.add_argument("--template", choices=("legacy", "composable"), default=index_template,
+                        help="register the mapping as index template instead of intercepting index creations")
+    parser.add_argument("--template-name", default=index_template_name)
+    parser.add_argument("--template-pattern", default=index_template_pattern,
+                        help="indices the template applies to (default: %(default)s)")
+    parser.add_argument("--template-verify-interval", type=float, default=index_template_verify_interval,
+                        help="seconds between template checks (default: %(default)s)")
+    parser.add_argument("--metrics-host", default=metrics_host)
+    parser.add_argument("--metrics-port", type=int, default=metrics_port,
+                        help="serve Prometheus metrics on this port (default: off)")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="also log request and response heads and bodies")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only log warnings and errors")
+    parser.add_argument("--log-body-limit", type=int, default=log_body_limit,
+                        help="bytes of a body logged with -v (default: %(default)s)")
+    args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers needs SO_REUSEPORT, which this platform does not have")
+    if args.workers > 1 and args.bulk_profile:
+        parser.error("--bulk-profile cannot be used with --workers, as the workers would restore each other's bulk-load settings")
+    if args.workers > 1 and args.dedupe:
+        parser.error("--dedupe cannot be used with --workers, as each worker would only see the duplicates it is sent")
+
+    proxy_engine = args.engine
+    proxy_workers = args.workers
+    proxy_listening_host = args.listen_host
+    proxy_listening_port = args.listen_port
+    target_elastic_host = args.es_host
+    target_elastic_port = args.es_port
+    target_elastic_nodes = args.es_node or target_elastic_nodes
+    upstream_pool_size = args.pool_size
+    upstream_compression = args.compress
+    upstream_compression_level = args.compression_level
+    bulk_coerce_values = args.coerce
+    relay_splice = relay_splice and not args.no_splice
+    mapping_learning = mapping_learning and not args.no_learn
+    mapping_cache_file = args.mapping_cache
+    mapping_profile = args.mapping_profile
+    mapping_alldata_fields = args.alldata_fields
+    putmappingbody = mapping_body(mapping_profile, mapping_alldata_fields)
+    buffer_high_watermark = args.buffer_high
+    buffer_low_watermark = args.buffer_low
+    global_buffer_high_watermark = args.global_buffer_high
+    global_buffer_low_watermark = args.global_buffer_low
+    bulk_rebatch = args.rebatch
+    bulk_batch_bytes = args.batch_bytes
+    bulk_batch_documents = args.batch_docs
+    bulk_batch_linger = args.batch_linger
+    bulk_fanout = args.fanout
+    bulk_profile = args.bulk_profile
+    index_routing_time = args.route_time
+    index_routing_field = args.route_by
+    document_ids = args.stable_ids
+    document_id_fields = args.id_fields
+    dedupe = args.dedupe
+    dedupe_fields = args.dedupe_fields
+    dedupe_file = args.dedupe_file
+    dedupe_max_bytes = args.dedupe_max_mb * 1048576
+    bulk_profile_idle_time = args.profile_idle_time
+    bulk_profile_forcemerge = args.forcemerge
+    bulk_fanout_min_bytes = args.fanout_min_bytes
+    bulk_retry_rejected = bulk_retry_rejected and not args.no_retry
+    bulk_retry_attempts = args.retry_attempts
+    journal_directory = args.journal
+    journal_segment_size = args.journal_segment_size
+    journal_fsync = journal_fsync and not args.journal_no_fsync
+    index_template = args.template
+    index_template_name = args.template_name
+    index_template_pattern = args.template_pattern
+    index_template_verify_interval = args.template_verify_interval
+    metrics_host = args.metrics_host
+    metrics_port = args.metrics_port
+    log_level = logging.DEBUG if args.verbose else logging.WARNING if args.quiet else logging.INFO
+    log_body_limit = args.log_body_limit
+
+
+if __name__ == '__main__':
+
+    parse_command_line()
+
+    if proxy_workers > 1:
+        supervisor = WorkerSupervisor()
+        stop_logging = setup_logging(supervisor.snapshot)
+        metrics_server = start_metrics_server(supervisor.snapshot) if metrics_port is not None else None
+        supervisor.run()
+    else:
+        stop_logging = setup_logging(metrics.snapshot)
+        run_engine()
+
+    log.info("Proxy terminated. Over and Out!")
+    stop_logging()